@@ -0,0 +1,114 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 設定のうち、ステップの出力に影響しないキー
+IGNORED_CONFIG_KEYS = frozenset(['name', 'skip_flg', 'depends_on'])
+
+
+def config_hash(step_config):
+    config = {key: value for key, value in step_config.items() if key not in IGNORED_CONFIG_KEYS}
+    return hashlib.sha256(json.dumps(config, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+
+class BuildState:
+    """
+    ステップごとに、前回成功した時の 設定・ステップのコード・入力・出力 のハッシュを保存する（makeのような更新判定）。
+    全て前回と同じなら、そのステップは最新として実行を省略できる。
+    ファイルのハッシュは (サイズ, mtime) が変わったファイルだけ計算し直す。
+    """
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.files = {}
+        self.steps = {}
+        if os.path.exists(state_file):
+            try:
+                with open(state_file, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+                self.files = state.get('files', {})
+                self.steps = state.get('steps', {})
+            except (OSError, json.JSONDecodeError) as e:
+                logging.warning(f"ビルド状態ファイルを読み込めないため、全ステップを実行します: {state_file}: {e}")
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.files.get(path)
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['sha256']
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(block)
+        sha256 = h.hexdigest()
+        with self.lock:
+            self.files[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}
+        return sha256
+
+    def fingerprint(self, path):
+        """ファイルの内容のハッシュ。ディレクトリなら配下の全ファイル（相対パスと内容）のハッシュ。無ければNone"""
+        if os.path.isfile(path):
+            return self.file_hash(path)
+        if not os.path.isdir(path):
+            return None
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for filename in sorted(files):
+                file_path = os.path.join(root, filename)
+                h.update(os.path.relpath(file_path, path).encode('utf-8') + b'\0')
+                h.update(self.file_hash(file_path).encode('ascii') + b'\0')
+        return h.hexdigest()
+
+    def snapshot(self, planned_step, code_version):
+        return {
+            'config': config_hash(planned_step.config),
+            'code': code_version,
+            'inputs': {path: self.fingerprint(path) for path in planned_step.inputs},
+        }
+
+    def outdated_reason(self, planned_step, code_version):
+        """実行が必要ならその理由の文字列、最新なら None を返す"""
+        if not planned_step.inputs:
+            # 入力ファイルの無いステップ（Webのスクレイピングなど）は外部の変化を判定できないので常に実行する
+            return "入力ファイルが登録されていないステップ"
+        with self.lock:
+            previous = self.steps.get(planned_step.name)
+        if previous is None:
+            return "前回の実行記録なし"
+        current = self.snapshot(planned_step, code_version)
+        if current['config'] != previous.get('config'):
+            return "設定が変更された"
+        if current['code'] != previous.get('code'):
+            return "ステップのコードが変更された"
+        for path, fingerprint in current['inputs'].items():
+            if fingerprint is None:
+                return f"入力が存在しない: {path}"
+            if fingerprint != previous.get('inputs', {}).get(path):
+                return f"入力が変更された: {path}"
+        for path in planned_step.outputs:
+            if self.fingerprint(path) != previous.get('outputs', {}).get(path):
+                return f"出力が無い、または変更された: {path}"
+        return None
+
+    def record(self, planned_step, code_version):
+        """ステップの成功後に、今回の入力・出力のハッシュを保存する"""
+        entry = self.snapshot(planned_step, code_version)
+        entry['outputs'] = {path: self.fingerprint(path) for path in planned_step.outputs}
+        with self.lock:
+            self.steps[planned_step.name] = entry
+            self.save()
+
+    def save(self):
+        state_dir = os.path.dirname(self.state_file)
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        with open(self.state_file + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'files': self.files, 'steps': self.steps}, f, ensure_ascii=False, indent=2)
+        os.replace(self.state_file + '.tmp', self.state_file)
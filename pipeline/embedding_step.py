@@ -1,9 +1,14 @@
 import os
 import json
+import time
+import argparse
 import torch        
 from transformers import BertTokenizer, BertModel 
-from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
+from lib.embedding_store import save_embedding_store, save_embeddings_json, EmbeddingStoreWriter
+from lib.embedding_cache import EmbeddingCache
+from lib.law_text import load_law_texts
+import pipeline_metrics
 
 import logging  # ログ出力のために追加
 
@@ -17,8 +22,33 @@ class EmbeddingStep:
     def __init__(self, step_config):
         self.law_catalog_file = step_config['law_catalog_json']
         self.embeddings_file = step_config['embeddings_file']
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-        self.model = BertModel.from_pretrained('bert-base-uncased')
+        # 法令ごとの抽出テキストの中間ファイル（JSONL）。未指定なら毎回法令JSONから抽出する
+        self.law_text_file = step_config.get('law_text_file')
+        # npy: メモリマップ可能な .npy + entriesサイドカー / json: 従来のJSON形式
+        self.embeddings_format = step_config.get('embeddings_format', 'npy')
+        self.embeddings_dtype = step_config.get('embeddings_dtype', 'float32')
+        # batch: 長さ順バケットでまとめて推論 / single: 従来通り1件ずつ推論
+        # chunked: 512トークンで切り捨てず、重なりのあるウィンドウに分割して全文をベクトル化
+        self.embedding_mode = step_config.get('embedding_mode', 'batch')
+        self.chunk_size = int(step_config.get('chunk_size', 512))
+        self.chunk_overlap = int(step_config.get('chunk_overlap', 128))
+        # チャンク単位のベクトル（パッセージ検索用）の出力先。未指定なら保存しない
+        self.chunk_embeddings_file = step_config.get('chunk_embeddings_file')
+        self.embedder = BertEmbedder(
+            step_config.get('model_name', 'bert-base-uncased'),
+            batch_size=int(step_config.get('batch_size', 16)),
+            num_threads=step_config.get('num_threads'),
+        )
+        # 抽出テキストのハッシュをキーにしたベクトルキャッシュ（未指定なら毎回全件ベクトル化）
+        cache_file = step_config.get('embedding_cache_file')
+        if cache_file and self.embedding_mode == 'chunked' and self.chunk_embeddings_file:
+            # キャッシュヒットした法令のチャンクベクトルが出力できないため併用しない
+            logging.warning("chunk_embeddings_file を出力する場合はベクトルキャッシュを使用しません")
+            cache_file = None
+        cache_key = self.embedder.cache_key()
+        if self.embedding_mode == 'chunked':
+            cache_key += f":chunked={self.chunk_size}/{self.chunk_overlap}"
+        self.embedding_cache = EmbeddingCache(cache_file, cache_key) if cache_file else None
 
     # law catalog jsonの読み込み
     def load_json_data(self, file_path):
@@ -26,86 +56,271 @@ class EmbeddingStep:
         with open(file_path, 'r', encoding='utf-8') as f:
             return json.load(f)
 
-    # law catalog
-    def save_embeddings_to_file(self, embeddings, entries, output_file):
-        """ベクトルデータをJSONファイルに保存する"""
-        data = {
-            'embeddings': embeddings.tolist(),
-            'entries': entries
-        }
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f)
-
     # vector化した概要と対応するサービス情報をファイルに保存
     def save_embeddings_to_file(self, embeddings, entries, output_file):
-        """ベクトルデータをJSONファイルに保存する"""
-        data = {
-            'embeddings': embeddings.tolist(),
-            'entries': entries
-        }
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f)
+        """ベクトルデータを保存する（npy: .npy + entriesサイドカー / json: 従来形式）"""
+        if self.embeddings_format == 'json':
+            save_embeddings_json(output_file, embeddings, entries)
+            logging.info(f"ベクトルをJSON形式で出力しました: {output_file}")
+        else:
+            vectors_path, entries_path = save_embedding_store(output_file, embeddings, entries, dtype=self.embeddings_dtype)
+            logging.info(f"ベクトルを出力しました: {vectors_path} ({self.embeddings_dtype}), {entries_path}")
 
 
     # 渡されたtextをベクトル化
     def get_embedding(self, text):
         """テキストをベクトル化する"""
-        if isinstance(text, list):  # リストなら結合して1つの文字列にする
-            text = " ".join(text)
-        inputs = self.tokenizer(text, return_tensors='pt', max_length=512, truncation=True)
-        outputs = self.model(**inputs)
-        embedding = outputs.last_hidden_state.mean(dim=1)
-        return embedding.detach().numpy()
-
-    def extract_text(self, law):
-        """Lawオブジェクトから特定のフィールドのテキストを抽出"""
-        texts = []
-        fields = ['@Abbrev', '#text', 'EnactStatement', 'ChapterTitle', 'ArticleCaption', 'ArticleTitle', 'Sentence']
-
-        for key, value in law.items():
-            if key in fields and isinstance(value, str):
-                texts.append(value)
-            elif isinstance(value, dict):
-                texts.extend(self.extract_text(value))
-            elif isinstance(value, list):
-                for item in value:
-                    if isinstance(item, dict):
-                        texts.extend(self.extract_text(item))
-        return texts
+        return self.embedder.embed(text)
 
     # law catalog中の全概要をvector化
-    def get_overview_embeddings(self, law_catalog):
-        """全ての概要をベクトル化する"""
-        overview_embeddings = []
+    def get_overview_embeddings(self, law_records):
+        """全ての概要をベクトル化する（law_records は lib.law_text.load_law_texts のレコード）"""
+        overviews = []
         entries = []
 
-        for law in law_catalog:
-            #logging.info(f"Service data: {law}")
-
-            law = law.get("Law")
-            overview = self.extract_text(law)
+        for record in law_records:
+            overview = record['texts']
 
             if overview:
-                embedding = self.get_embedding(overview)
-                overview_embeddings.append(embedding)
+                overviews.append(overview)
 
-                law_num = law.get("LawNum")
-                law_title = law.get("LawBody").get("LawTitle").get("@Abbrev")
-                law_text = law.get("LawBody").get("LawTitle").get("#text")
-    
                 entry = {
-                    'law_num': law_num,
-                    'law_title': law_title,
-                    'law_text': law_text
+                    'law_num': record['law_num'],
+                    'law_title': record['law_title'],
+                    'law_text': record['law_text']
                 }
                 entries.append(entry)
 
-        return np.vstack(overview_embeddings), entries
+        if self.embedding_cache is None:
+            return self.embed_overviews(overviews, entries), entries
+
+        # キャッシュに無い（新規・変更された）法令だけをベクトル化する
+        keys = [self.embedding_cache.make_key(overview) for overview in overviews]
+        cached = [self.embedding_cache.get(key) for key in keys]
+        missing = [i for i, vector in enumerate(cached) if vector is None]
+        logging.info(f"ベクトルキャッシュ: hit={self.embedding_cache.hits}, miss={self.embedding_cache.misses}")
+        pipeline_metrics.incr('embedding_cache_hits', self.embedding_cache.hits)
+        pipeline_metrics.incr('embedding_cache_misses', self.embedding_cache.misses)
+
+        new_embeddings = self.embed_overviews([overviews[i] for i in missing], [entries[i] for i in missing]) if missing else None
+        overview_embeddings = np.zeros((len(overviews), self.embedding_dim(cached, new_embeddings)), dtype=np.float32)
+        for i, vector in enumerate(cached):
+            if vector is not None:
+                overview_embeddings[i] = vector
+        if missing:
+            overview_embeddings[missing] = new_embeddings
+
+        self.embedding_cache.save(keys, overview_embeddings)
+        return overview_embeddings, entries
+
+    @staticmethod
+    def embedding_dim(cached, new_embeddings):
+        if new_embeddings is not None:
+            return new_embeddings.shape[1]
+        return next((len(vector) for vector in cached if vector is not None), 0)
+
+    def embed_overviews(self, overviews, entries):
+        """概要のリストをベクトル化し、処理速度をログに出す"""
+        start = time.perf_counter()
+        if self.embedding_mode == 'single':
+            overview_embeddings = np.vstack([self.get_embedding(overview) for overview in overviews])
+        elif self.embedding_mode == 'chunked':
+            overview_embeddings = self.embed_chunked_overviews(overviews, entries)
+        else:
+            overview_embeddings = self.embedder.embed_batch(overviews)
+        elapsed = time.perf_counter() - start
+        pipeline_metrics.incr('laws_embedded', len(overviews))
+        if overviews:
+            logging.info(f"ベクトル化完了 ({self.embedding_mode}): {len(overviews)}件, {elapsed:.1f}秒, {len(overviews) / max(elapsed, 1e-9):.2f} laws/sec")
+        return overview_embeddings
+
+    def embed_chunked_overviews(self, overviews, entries):
+        """長い法令をウィンドウ分割してベクトル化し、必要ならチャンク単位のベクトルも保存する"""
+        if not self.chunk_embeddings_file:
+            return self.embedder.embed_chunked(overviews, self.chunk_size, self.chunk_overlap)
+
+        writer = EmbeddingStoreWriter(self.chunk_embeddings_file, dtype=self.embeddings_dtype)
+
+        def write_chunks(chunk_refs, vectors):
+            chunk_entries = [
+                {
+                    'law_num': entries[law_index]['law_num'],
+                    'chunk': chunk_no,
+                    'token_start': token_start,
+                    'token_end': token_end
+                }
+                for law_index, chunk_no, token_start, token_end in chunk_refs
+            ]
+            writer.append(vectors, chunk_entries)
+
+        overview_embeddings = self.embedder.embed_chunked(overviews, self.chunk_size, self.chunk_overlap, chunk_sink=write_chunks)
+        vectors_path, _ = writer.close()
+        logging.info(f"チャンクベクトルを出力しました: {vectors_path} ({writer.rows}件)")
+        return overview_embeddings
 
     def execute(self):
-        self.law_catalog = self.load_json_data(self.law_catalog_file)
-        self.overview_embeddings, self.entries = self.get_overview_embeddings(self.law_catalog)
+        # 抽出済みテキスト（law_text_file）が最新なら、法令JSON全体は読み込まない
+        self.law_records = load_law_texts(self.law_catalog_file, self.law_text_file)
+        self.overview_embeddings, self.entries = self.get_overview_embeddings(self.law_records)
+        pipeline_metrics.add_items(len(self.entries))
         if self.embeddings_file:
             self.save_embeddings_to_file(self.overview_embeddings, self.entries, self.embeddings_file)
 
 
+class BertEmbedder:
+    """BERTでテキストをベクトル化する（CPU向けのバッチ推論に対応）"""
+
+    def __init__(self, model_name, batch_size=16, num_threads=None, max_length=512):
+        if num_threads:
+            # intra-opスレッド数（未指定ならtorchの既定値）
+            torch.set_num_threads(int(num_threads))
+        self.model_name = model_name
+        self.batch_size = max(1, batch_size)
+        self.max_length = max_length
+        # モデルは最初にベクトル化するときに読み込む（全件キャッシュヒットなら読み込まない）
+        self.tokenizer = None
+        self.model = None
+
+    def load_model(self):
+        if self.model is None:
+            self.tokenizer = BertTokenizer.from_pretrained(self.model_name)
+            self.model = BertModel.from_pretrained(self.model_name)
+            self.model.eval()
+
+    def cache_key(self):
+        """ベクトルの値に影響する設定（キャッシュキーに含める）"""
+        return f"{self.model_name}:max_length={self.max_length}"
+
+    @staticmethod
+    def join_text(text):
+        # リストなら結合して1つの文字列にする
+        return " ".join(text) if isinstance(text, list) else text
+
+    def embed(self, text):
+        """1件のテキストをベクトル化する（shape: (1, hidden_size)）"""
+        self.load_model()
+        inputs = self.tokenizer(self.join_text(text), return_tensors='pt', max_length=self.max_length, truncation=True)
+        with torch.inference_mode():
+            outputs = self.model(**inputs)
+        return outputs.last_hidden_state.mean(dim=1).numpy()
+
+    def embed_batch(self, texts):
+        """
+        複数のテキストをまとめてベクトル化する。
+        トークン長でソートしてバッチを組むため、パディングはバッチ内の最大長までで済む。
+        """
+        self.load_model()
+        input_ids = self.tokenizer(
+            [self.join_text(text) for text in texts], max_length=self.max_length, truncation=True
+        )['input_ids']
+        order = sorted(range(len(input_ids)), key=lambda i: len(input_ids[i]))
+
+        embeddings = np.zeros((len(input_ids), self.model.config.hidden_size), dtype=np.float32)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            features = self.tokenizer.pad({'input_ids': [input_ids[i] for i in batch]}, return_tensors='pt')
+            embeddings[batch] = self.forward(features)
+        return embeddings
+
+    def iter_windows(self, texts, chunk_size, overlap):
+        """
+        法令ごとにトークン列を重なりのあるウィンドウに分割して順に返す。
+        1法令ずつトークナイズするので、保持するのは処理中の法令のトークン列だけ。
+        """
+        body = chunk_size - 2  # [CLS] と [SEP] の分
+        step = max(1, body - overlap)
+        for text_index, text in enumerate(texts):
+            parts = text if isinstance(text, list) else [text]
+            token_ids = []
+            for ids in self.tokenizer(parts, add_special_tokens=False)['input_ids']:
+                token_ids.extend(ids)
+            start = 0
+            chunk_no = 0
+            while True:
+                window = token_ids[start:start + body]
+                yield (text_index, chunk_no, start, start + len(window)), [self.tokenizer.cls_token_id] + window + [self.tokenizer.sep_token_id]
+                if start + body >= len(token_ids):
+                    break
+                start += step
+                chunk_no += 1
+
+    def embed_chunked(self, texts, chunk_size=512, overlap=128, chunk_sink=None):
+        """
+        テキストを切り捨てずに重なりのあるウィンドウへ分割し、全ウィンドウを共通のバッチで推論する。
+        法令ベクトルはウィンドウのトークン数で重み付けした平均。
+        chunk_sink を渡すと、バッチごとに (チャンク情報のリスト, チャンクベクトル) を渡す。
+        バッチ単位で集約するので、1法令が数千チャンクになってもメモリ使用量は増えない。
+        """
+        self.load_model()
+        dim = self.model.config.hidden_size
+        sums = np.zeros((len(texts), dim), dtype=np.float64)
+        weights = np.zeros(len(texts), dtype=np.float64)
+
+        def flush(batch):
+            refs = [ref for ref, _ in batch]
+            features = self.tokenizer.pad({'input_ids': [ids for _, ids in batch]}, return_tensors='pt')
+            vectors = self.forward(features)
+            for (text_index, _, token_start, token_end), vector in zip(refs, vectors):
+                weight = max(1, token_end - token_start)
+                sums[text_index] += vector * weight
+                weights[text_index] += weight
+            if chunk_sink is not None:
+                chunk_sink(refs, vectors)
+
+        batch = []
+        for window in self.iter_windows(texts, chunk_size, overlap):
+            batch.append(window)
+            if len(batch) >= self.batch_size:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+
+        return (sums / np.maximum(weights, 1)[:, None]).astype(np.float32)
+
+    def forward(self, features):
+        """パディングを除外した平均プーリングでベクトルを求める"""
+        with torch.inference_mode():
+            outputs = self.model(**features)
+        hidden = outputs.last_hidden_state
+        mask = features['attention_mask'].unsqueeze(-1).to(hidden.dtype)
+        summed = (hidden * mask).sum(dim=1)
+        counts = mask.sum(dim=1).clamp(min=1)
+        return (summed / counts).numpy()
+
+
+def benchmark(law_catalog_json, sample=64, model_name='bert-base-uncased', batch_size=16, law_text_file=None):
+    """
+    同じ法令（先頭のsample件）を single（1件ずつ）と batch（長さ順のバッチ）でベクトル化し、
+    laws/sec と、両者のベクトルの最大絶対誤差（パディングを除いた平均プーリングが同じ結果になるか）を表示する。
+    キャッシュは使わず、モデルの読み込み時間は含めない。
+    """
+    records = [record for record in load_law_texts(law_catalog_json, law_text_file) if record['texts']][:sample]
+    overviews = [record['texts'] for record in records]
+    step = EmbeddingStep({
+        'law_catalog_json': law_catalog_json,
+        'embeddings_file': '',
+        'model_name': model_name,
+        'batch_size': batch_size,
+    })
+    step.embedder.load_model()
+    results = {}
+    for mode in ('single', 'batch'):
+        step.embedding_mode = mode
+        start = time.perf_counter()
+        results[mode] = step.embed_overviews(overviews, records)
+        elapsed = time.perf_counter() - start
+        print(f"{mode}: {len(overviews)} laws in {elapsed:.1f}s ({len(overviews) / max(elapsed, 1e-9):.2f} laws/sec)")
+    diff = np.abs(results['single'] - results['batch'])
+    print(f"max |single - batch|: {diff.max():.2e} (mean {diff.mean():.2e}, batch_size={batch_size})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EmbeddingStepのベンチマーク（single / batch の速度とベクトルの一致）")
+    parser.add_argument('law_catalog_json', help="法令JSON（law_catalog_json）")
+    parser.add_argument('--sample', type=int, default=64, help="ベクトル化する法令の数")
+    parser.add_argument('--model-name', default='bert-base-uncased')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--law-text-file', help="抽出済みテキストのJSONL（あれば法令JSONを走査しない）")
+    args = parser.parse_args()
+    benchmark(args.law_catalog_json, args.sample, args.model_name, args.batch_size, args.law_text_file)
@@ -0,0 +1,77 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+
+
+def checkpoint_key(index, content):
+    """入力の位置と内容から、再開時に同じ入力か判定するためのキーを作る"""
+    return f"{index}:{hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]}"
+
+
+class JsonlCheckpoint:
+    """
+    完了した結果を1行1件のJSONLで追記していくチェックポイント。
+    fsync_every件ごとにfsyncするので、チェックポイントの書き込みが律速にならない。
+    """
+
+    def __init__(self, path, fsync_every=50):
+        self.path = path
+        self.fsync_every = max(1, int(fsync_every))
+        self.lock = threading.Lock()
+        self.file = None
+        self.pending = 0
+
+    def load(self):
+        """
+        書き込み済みの結果を {key: result} で返す。
+        途中で切れた最終行（改行で終わっていない行）はファイルから切り詰める（続きの追記がその行につながらないように）。
+        """
+        done = {}
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                logging.warning(f"チェックポイントの途中で切れた最終行を削除します: {self.path} ({len(data) - end}バイト)")
+                f.truncate(end)
+        for line in data[:end].decode('utf-8', errors='replace').splitlines():
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            done[record['key']] = record['result']
+        if done:
+            logging.info(f"チェックポイントから{len(done)}件を再開します: {self.path}")
+        return done
+
+    def append(self, key, result):
+        with self.lock:
+            if self.file is None:
+                checkpoint_dir = os.path.dirname(self.path)
+                if checkpoint_dir:
+                    os.makedirs(checkpoint_dir, exist_ok=True)
+                self.file = open(self.path, 'a', encoding='utf-8')
+            self.file.write(json.dumps({'key': key, 'result': result}, ensure_ascii=False) + '\n')
+            self.file.flush()
+            self.pending += 1
+            if self.pending >= self.fsync_every:
+                os.fsync(self.file.fileno())
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+                self.pending = 0
+
+    def remove(self):
+        """最終出力を書き終えた後にチェックポイントを削除する"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
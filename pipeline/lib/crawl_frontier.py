@@ -0,0 +1,122 @@
+import time
+import threading
+import urllib.robotparser
+from collections import deque
+from urllib.parse import urlsplit, urlunsplit
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def canonicalize_url(url):
+    """
+    同じページを指すURLを1つの表記にまとめる。
+    スキーム・ホストの小文字化、既定ポートの削除、フラグメントの削除、クエリの並べ替え（キーだけで安定ソート）。
+    正規化したURLをそのまま取得するので、クエリは & で分けた各項目を元の表記（値の無いキー、; 、%エンコード）のまま残し、
+    同じキーの項目の順序も変えない（CGIなどでは別のページを指すことがある）。
+    末尾の / は残す（/dir と /dir/ では相対リンクの解決先が異なり、多くのサーバは /dir を /dir/ へリダイレクトする）。
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    netloc = host if port is None or DEFAULT_PORTS.get(scheme) == port else f"{host}:{port}"
+    if parts.username:
+        netloc = f"{parts.username}{':' + parts.password if parts.password else ''}@{netloc}"
+    path = parts.path or '/'
+    query = '&'.join(sorted((item for item in parts.query.split('&') if item), key=lambda item: item.split('=', 1)[0]))
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+
+class CrawlFrontier:
+    """
+    未訪問URLのキュー（deque）と、キュー投入済み・訪問済みのURLの集合。
+    一度投入したURLは二度と投入しないので、キューに重複は入らない。
+    """
+
+    def __init__(self, to_visit=(), visited=()):
+        self.queue = deque()
+        self.seen = set(visited)
+        for url in to_visit:
+            self.push(url)
+
+    def push(self, url):
+        """新しいURLならキューに追加して True を返す"""
+        if not url or url in self.seen:
+            return False
+        self.seen.add(url)
+        self.queue.append(url)
+        return True
+
+    def pop(self):
+        return self.queue.popleft()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __bool__(self):
+        return bool(self.queue)
+
+    def to_list(self):
+        return list(self.queue)
+
+
+class RobotsCache:
+    """
+    ホストごとのrobots.txtをTTL（秒）の間キャッシュする（スレッドセーフ）。
+    取得はクローラーのセッションで行い、同じホストへの同時取得は1回にまとめる。
+    """
+
+    def __init__(self, session, user_agent, ttl=3600, timeout=30):
+        self.session = session
+        self.user_agent = user_agent
+        self.ttl = ttl
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.parsers = {}
+        self.host_locks = {}
+
+    def host_lock(self, origin):
+        with self.lock:
+            return self.host_locks.setdefault(origin, threading.Lock())
+
+    def fetch(self, origin):
+        parser = urllib.robotparser.RobotFileParser()
+        parser.set_url(f"{origin}/robots.txt")
+        try:
+            response = self.session.get(f"{origin}/robots.txt", timeout=self.timeout)
+        except Exception:
+            # 取得できない場合は urllib.robotparser と同じく全て許可する
+            parser.allow_all = True
+            return parser
+        if response.status_code in (401, 403):
+            parser.disallow_all = True
+        elif response.status_code >= 400:
+            parser.allow_all = True
+        else:
+            parser.parse(response.text.splitlines())
+        return parser
+
+    def get_parser(self, url):
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        now = time.monotonic()
+        with self.lock:
+            cached = self.parsers.get(origin)
+        if cached and cached[0] > now:
+            return cached[1]
+        with self.host_lock(origin):
+            with self.lock:
+                cached = self.parsers.get(origin)
+            if cached and cached[0] > time.monotonic():
+                return cached[1]
+            parser = self.fetch(origin)
+            with self.lock:
+                self.parsers[origin] = (time.monotonic() + self.ttl, parser)
+            return parser
+
+    def can_fetch(self, url):
+        return self.get_parser(url).can_fetch(self.user_agent, url)
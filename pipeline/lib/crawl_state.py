@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+from urllib.request import pathname2url
+
+
+class CrawlState:
+    """
+    クロールの進行状況（訪問済みURL→保存ファイル、未訪問URLのキュー）を保存するSQLite。
+    1ページごとの更新は1行の追加・削除で、commit() の単位でまとめて確定する（途中で落ちても壊れない）。
+    URL→保存ファイルの検索は主キーで引くので、全体を読み込む必要がない。
+    """
+
+    def __init__(self, db_path, read_only=False):
+        """read_only: 後続ステップが参照だけする場合。DBが無ければ FileNotFoundError（空のDBを作らない）"""
+        self.db_path = db_path
+        if read_only:
+            if not os.path.exists(db_path):
+                raise FileNotFoundError(f"{db_path} does not exist.")
+            self.conn = sqlite3.connect(f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro", uri=True)
+            self.columns = {row[1] for row in self.conn.execute("PRAGMA table_info(visited)")}
+            return
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS visited (url TEXT PRIMARY KEY, file_path TEXT, fetched_at REAL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS frontier (seq INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT UNIQUE)")
+        # 再クロール用の検証子（ETag / Last-Modified）と内容のハッシュ、内容が最後に変わった日時
+        self.columns = {row[1] for row in self.conn.execute("PRAGMA table_info(visited)")}
+        for column, column_type in (('etag', 'TEXT'), ('last_modified', 'TEXT'), ('content_hash', 'TEXT'), ('changed_at', 'REAL')):
+            if column not in self.columns:
+                self.conn.execute(f"ALTER TABLE visited ADD COLUMN {column} {column_type}")
+                self.columns.add(column)
+        self.conn.commit()
+
+    def is_empty(self):
+        return (self.conn.execute("SELECT 1 FROM visited LIMIT 1").fetchone() is None
+                and self.conn.execute("SELECT 1 FROM frontier LIMIT 1").fetchone() is None)
+
+    def import_progress_file(self, progress_file):
+        """従来の進行状況JSON（visited / to_visit）を取り込む"""
+        with open(progress_file, 'r') as file:
+            progress_data = json.load(file)
+        now = time.time()
+        self.conn.executemany("INSERT OR REPLACE INTO visited (url, file_path, fetched_at, changed_at) VALUES (?, ?, ?, ?)",
+                              ((url, file_path, now, now) for url, file_path in progress_data.get('visited', {}).items()))
+        self.conn.executemany("INSERT OR IGNORE INTO frontier (url) VALUES (?)",
+                              ((url,) for url in progress_data.get('to_visit', []) if url))
+        self.conn.commit()
+        logging.info(f"進行状況ファイルを取り込みました: {progress_file} -> {self.db_path}")
+
+    def visited(self):
+        """{url: file_path}"""
+        return dict(self.conn.execute("SELECT url, file_path FROM visited"))
+
+    def frontier(self):
+        """未訪問URLを追加順に返す"""
+        return [url for (url,) in self.conn.execute("SELECT url FROM frontier ORDER BY seq")]
+
+    def validators(self):
+        """{url: {'etag', 'last_modified', 'content_hash'}}（再クロールの条件付きリクエスト用）"""
+        return {
+            url: {'etag': etag, 'last_modified': last_modified, 'content_hash': content_hash}
+            for url, etag, last_modified, content_hash in self.conn.execute("SELECT url, etag, last_modified, content_hash FROM visited")
+        }
+
+    def changed_since(self, timestamp):
+        """timestamp より後に新規取得・内容が変わったURLの集合（changed_at が無い古い行は取得日時で判定する）"""
+        # 読み取り専用で開いた古いDB（changed_at列の追加前）は取得日時で判定する
+        changed_at = "COALESCE(changed_at, fetched_at)" if 'changed_at' in self.columns else "fetched_at"
+        return {url for (url,) in self.conn.execute(f"SELECT url FROM visited WHERE {changed_at} > ?", (timestamp,))}
+
+    def lookup(self, url):
+        row = self.conn.execute("SELECT file_path FROM visited WHERE url = ?", (url,)).fetchone()
+        return row[0] if row else None
+
+    def record_visit(self, url, file_path, etag=None, last_modified=None, content_hash=None, changed=True):
+        """訪問を記録する。changed=False（内容が前回と同じ）なら changed_at は更新しない"""
+        now = time.time()
+        self.conn.execute(
+            """INSERT INTO visited (url, file_path, fetched_at, etag, last_modified, content_hash, changed_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(url) DO UPDATE SET
+                   file_path = excluded.file_path, fetched_at = excluded.fetched_at,
+                   etag = excluded.etag, last_modified = excluded.last_modified,
+                   content_hash = COALESCE(excluded.content_hash, visited.content_hash),
+                   changed_at = CASE WHEN ? THEN excluded.changed_at ELSE visited.changed_at END""",
+            (url, file_path, now, etag, last_modified, content_hash, now, 1 if changed else 0)
+        )
+        self.conn.execute("DELETE FROM frontier WHERE url = ?", (url,))
+
+    def push(self, url):
+        self.conn.execute("INSERT OR IGNORE INTO frontier (url) VALUES (?)", (url,))
+
+    def discard(self, url):
+        """取得できなかった・対象外のURLをキューから外す"""
+        self.conn.execute("DELETE FROM frontier WHERE url = ?", (url,))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
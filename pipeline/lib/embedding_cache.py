@@ -0,0 +1,60 @@
+import os
+import hashlib
+import logging
+import numpy as np
+from lib.embedding_store import load_embedding_store, save_embedding_store, store_paths
+
+
+class EmbeddingCache:
+    """
+    抽出テキストとモデル名のハッシュをキーにしたベクトルの永続キャッシュ。
+    embedding_store と同じ形式（.npy + entriesサイドカー）で保存する。
+    """
+
+    def __init__(self, cache_file, model_key):
+        self.cache_file = cache_file
+        self.model_key = model_key
+        self.vectors = None
+        self.key_to_row = {}
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        vectors_path, entries_path = store_paths(self.cache_file)
+        if not (os.path.exists(vectors_path) and os.path.exists(entries_path)):
+            return
+        try:
+            self.vectors, entries = load_embedding_store(self.cache_file, mmap=True)
+        except Exception as e:
+            logging.warning(f"ベクトルキャッシュを読み込めないため作り直します: {self.cache_file} ({e})")
+            return
+        self.key_to_row = {entry['key']: row for row, entry in enumerate(entries)}
+
+    def make_key(self, texts):
+        """モデル名と抽出テキストからキャッシュキーを作る"""
+        h = hashlib.sha256(self.model_key.encode('utf-8'))
+        for text in texts:
+            h.update(b'\x1f')
+            h.update(text.encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, key):
+        row = self.key_to_row.get(key)
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.vectors[row]
+
+    def save(self, keys, embeddings):
+        """今回の全件でキャッシュを書き直す（削除された法令のエントリはここで消える）"""
+        rows = {}
+        for row, key in enumerate(keys):
+            rows.setdefault(key, row)
+        unique_rows = list(rows.values())
+        entries = [{'key': key} for key in rows]
+        # 書き込み前に、上書き対象ファイルのメモリマップを解放する
+        self.vectors = None
+        save_embedding_store(self.cache_file, np.asarray(embeddings)[unique_rows], entries)
+        self.load()
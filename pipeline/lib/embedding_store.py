@@ -0,0 +1,114 @@
+import os
+import json
+import shutil
+import numpy as np
+
+
+# ベクトル本体は .npy (float32 / float16)、entries は1行1件のJSONLで保存する
+VECTORS_SUFFIX = '.npy'
+ENTRIES_SUFFIX = '.entries.jsonl'
+
+
+def store_paths(path):
+    """保存先パスからベクトル本体とentriesサイドカーのパスを求める"""
+    base, ext = os.path.splitext(path)
+    if ext not in ('.npy', '.json'):
+        base = path
+    return base + VECTORS_SUFFIX, base + ENTRIES_SUFFIX
+
+
+def save_embedding_store(path, embeddings, entries, dtype='float32'):
+    """ベクトルを .npy、entriesをJSONLで保存する"""
+    vectors_path, entries_path = store_paths(path)
+    output_dir = os.path.dirname(vectors_path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    matrix = np.ascontiguousarray(embeddings, dtype=np.dtype(dtype))
+    # np.save はパスを渡すと拡張子を付け足すため、ファイルオブジェクトに書く
+    with open(vectors_path + '.tmp', 'wb') as f:
+        np.save(f, matrix)
+    with open(entries_path + '.tmp', 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')))
+            f.write('\n')
+    os.replace(vectors_path + '.tmp', vectors_path)
+    os.replace(entries_path + '.tmp', entries_path)
+    return vectors_path, entries_path
+
+
+class EmbeddingStoreWriter:
+    """
+    ベクトルを少しずつ追記して .npy ストアを作る。
+    件数が事前に分からないため、本体は一時ファイルに追記し、close() でヘッダを付けて書き出す。
+    """
+
+    def __init__(self, path, dtype='float32'):
+        self.vectors_path, self.entries_path = store_paths(path)
+        output_dir = os.path.dirname(self.vectors_path)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        self.dtype = np.dtype(dtype)
+        self.rows = 0
+        self.dim = None
+        self.raw_file = open(self.vectors_path + '.raw', 'wb')
+        self.entries_file = open(self.entries_path + '.tmp', 'w', encoding='utf-8')
+
+    def append(self, vectors, entries):
+        vectors = np.ascontiguousarray(vectors, dtype=self.dtype)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        vectors.tofile(self.raw_file)
+        for entry in entries:
+            self.entries_file.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')))
+            self.entries_file.write('\n')
+        self.rows += vectors.shape[0]
+
+    def close(self):
+        self.raw_file.close()
+        self.entries_file.close()
+        header = {'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False, 'shape': (self.rows, self.dim or 0)}
+        with open(self.vectors_path + '.tmp', 'wb') as f, open(self.vectors_path + '.raw', 'rb') as raw:
+            np.lib.format.write_array_header_1_0(f, header)
+            shutil.copyfileobj(raw, f, 1024 * 1024)
+        os.remove(self.vectors_path + '.raw')
+        os.replace(self.vectors_path + '.tmp', self.vectors_path)
+        os.replace(self.entries_path + '.tmp', self.entries_path)
+        return self.vectors_path, self.entries_path
+
+
+def load_entries(entries_path):
+    with open(entries_path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_embedding_store(path, mmap=True):
+    """
+    保存済みのベクトルとentriesを読み込む。
+    mmap=True の場合、ベクトルはコピーせずに読み取り専用でメモリマップする。
+    """
+    vectors_path, entries_path = store_paths(path)
+    vectors = np.load(vectors_path, mmap_mode='r' if mmap else None)
+    entries = load_entries(entries_path)
+    if len(entries) != vectors.shape[0]:
+        raise ValueError(f"ベクトル数({vectors.shape[0]})とentries数({len(entries)})が一致しません: {vectors_path}")
+    return vectors, entries
+
+
+def save_embeddings_json(output_file, embeddings, entries):
+    """従来形式（embeddingsをfloatのリストとして持つJSON）で書き出す"""
+    data = {
+        'embeddings': np.asarray(embeddings).tolist(),
+        'entries': entries
+    }
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+
+
+def load_embeddings(path, mmap=True):
+    """拡張子に応じて .npy ストアまたは従来のJSONを読み込む"""
+    if path.endswith('.json') and not os.path.exists(store_paths(path)[0]):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return np.asarray(data['embeddings'], dtype=np.float32), data['entries']
+    return load_embedding_store(path, mmap=mmap)
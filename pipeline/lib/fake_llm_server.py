@@ -0,0 +1,86 @@
+"""
+スループット確認用の OpenAI 互換フェイクサーバ（/v1/chat/completions のみ）。
+応答はプロンプトのハッシュから決まるので、同じ入力には常に同じ応答を返す。
+
+    python pipeline/lib/fake_llm_server.py --port 8000 --latency 0.5
+
+pipeline.yaml の llm_url に http://localhost:8000/v1/ を指定して使う。
+"""
+import json
+import time
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+TAG_WORDS = ["建築", "住宅", "安全", "都市計画", "防災", "土地", "道路", "環境", "手続", "補助"]
+
+
+def fake_response(prompt):
+    digest = hashlib.sha256(prompt.encode('utf-8')).digest()
+    tags = [TAG_WORDS[b % len(TAG_WORDS)] for b in digest[:3]]
+    tags = list(dict.fromkeys(tags))
+    # LlmTagStep は "tags" を含む行だけを取り出すので、tagsは1行で出力する
+    return "{\n  \"tags\": " + json.dumps(tags, ensure_ascii=False) + "\n}\n要約: " + digest.hex()[:16]
+
+
+class FakeLlmHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    request_count = 0
+    count_lock = threading.Lock()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_error(404)
+            return
+
+        with self.count_lock:
+            FakeLlmHandler.request_count += 1
+        time.sleep(self.latency)
+
+        prompt = "".join(message.get('content', '') for message in body.get('messages', []))
+        payload = json.dumps({
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get('model', 'fake'),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": fake_response(prompt)},
+                "finish_reason": "stop"
+            }],
+            "usage": {"prompt_tokens": len(prompt), "completion_tokens": 0, "total_tokens": len(prompt)}
+        }, ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port=0, latency=0.0):
+    """バックグラウンドスレッドでサーバを起動し、(server, base_url) を返す"""
+    FakeLlmHandler.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeLlmHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1/"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI互換フェイクLLMサーバ")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.5, help="1リクエストあたりの応答遅延（秒）")
+    args = parser.parse_args()
+    FakeLlmHandler.latency = args.latency
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), FakeLlmHandler)
+    server.daemon_threads = True
+    print(f"fake LLM server: http://127.0.0.1:{args.port}/v1/ (latency {args.latency}s)")
+    server.serve_forever()
@@ -0,0 +1,134 @@
+"""
+クローラーのスループット確認用のローカルWebサイト。
+/page/<n>.html が他のページへのリンクを持つHTMLを返し、/robots.txt は全て許可する。
+ページには ETag / Last-Modified を付け、If-None-Match / If-Modified-Since が一致すれば 304 を返す。
+revisions[n] を増やすとページnの内容（とETag）が変わる。
+
+    python pipeline/lib/fake_site_server.py --port 8001 --pages 200 --latency 0.05
+
+pipeline.yaml の start_url に http://127.0.0.1:8001/page/0.html を指定して使う。
+"""
+import time
+import hashlib
+import argparse
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def page_links(n, pages, links_per_page):
+    """ページnからリンクするページ番号（サイト全体が辿れるように n+1 を必ず含める）"""
+    return sorted({(n + 1) % pages} | {(n * 7 + i * 13) % pages for i in range(links_per_page - 1)})
+
+
+class FakeSiteHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    pages = 100
+    links_per_page = 5
+    latency = 0.0
+    # ページ番号→版（内容を変えたページだけ）
+    revisions = {}
+    # 全ページの最終更新日時（Last-Modified）
+    last_modified = 0.0
+    request_count = 0
+    not_modified_count = 0
+    connection_count = 0
+    count_lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        # keep-aliveで接続が再利用されているかを確認するため、接続数を数える
+        with self.count_lock:
+            FakeSiteHandler.connection_count += 1
+
+    def send_body(self, body, content_type, headers=None):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        with self.count_lock:
+            FakeSiteHandler.request_count += 1
+        if self.path == '/robots.txt':
+            self.send_body(b"User-agent: *\nAllow: /\n", 'text/plain')
+            return
+        if not (self.path.startswith('/page/') and self.path.endswith('.html')):
+            self.send_error(404)
+            return
+        try:
+            n = int(self.path[len('/page/'):-len('.html')])
+        except ValueError:
+            self.send_error(404)
+            return
+        if not 0 <= n < self.pages:
+            self.send_error(404)
+            return
+
+        time.sleep(self.latency)
+        links = "".join(f'<li><a href="/page/{m}.html">ページ{m}</a></li>' for m in page_links(n, self.pages, self.links_per_page))
+        body = (
+            '<html><head><meta charset="utf-8"><title>ページ' + str(n) + '</title></head><body>'
+            '<div id="contents"><h1>ページ' + str(n) + '</h1><p>' + 'テスト用の本文です。' * 20 + '</p>'
+            '<p>版: ' + str(self.revisions.get(n, 0)) + '</p>'
+            '<ul>' + links + '</ul></div></body></html>'
+        ).encode('utf-8')
+        etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+        if self.is_not_modified(etag, n):
+            with self.count_lock:
+                FakeSiteHandler.not_modified_count += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_body(body, 'text/html; charset=utf-8', {'ETag': etag, 'Last-Modified': formatdate(self.last_modified, usegmt=True)})
+
+    def is_not_modified(self, etag, n):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            return etag in [tag.strip() for tag in if_none_match.split(',')]
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since and n not in self.revisions:
+            try:
+                return parsedate_to_datetime(if_modified_since).timestamp() >= int(self.last_modified)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port=0, pages=100, links_per_page=5, latency=0.0):
+    """バックグラウンドスレッドでサーバを起動し、(server, start_url) を返す"""
+    FakeSiteHandler.pages = pages
+    FakeSiteHandler.links_per_page = links_per_page
+    FakeSiteHandler.latency = latency
+    FakeSiteHandler.revisions = {}
+    FakeSiteHandler.last_modified = time.time()
+    FakeSiteHandler.request_count = 0
+    FakeSiteHandler.not_modified_count = 0
+    FakeSiteHandler.connection_count = 0
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeSiteHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/page/0.html"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="クローラー確認用のローカルWebサイト")
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--links-per-page', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.05, help="1ページあたりの応答遅延（秒）")
+    args = parser.parse_args()
+    server, start_url = start_server(args.port, args.pages, args.links_per_page, args.latency)
+    print(f"fake site: {start_url} ({args.pages} pages, latency {args.latency}s)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,39 @@
+import time
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+
+class HostThrottle:
+    """
+    ホストごとの同時リクエスト数と、リクエスト開始の最小間隔（秒）を制限する（スレッドセーフ）。
+    別のホストへのリクエストは互いに待たない。
+    """
+
+    def __init__(self, max_concurrency=2, delay=1.0):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.delay = float(delay)
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def host_state(self, host):
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                state = {'semaphore': threading.BoundedSemaphore(self.max_concurrency), 'lock': threading.Lock(), 'next_time': 0.0}
+                self.hosts[host] = state
+            return state
+
+    @contextmanager
+    def slot(self, url):
+        """with throttle.slot(url): の中でリクエストする"""
+        state = self.host_state(urlparse(url).netloc)
+        with state['semaphore']:
+            if self.delay > 0:
+                with state['lock']:
+                    now = time.monotonic()
+                    wait = state['next_time'] - now
+                    state['next_time'] = max(now, state['next_time']) + self.delay
+                if wait > 0:
+                    time.sleep(wait)
+            yield
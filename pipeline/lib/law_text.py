@@ -0,0 +1,98 @@
+import os
+import json
+import logging
+
+
+# テキストとして抽出する法令JSONのフィールド
+LAW_TEXT_FIELDS = frozenset(['@Abbrev', '#text', 'EnactStatement', 'ChapterTitle', 'ArticleCaption', 'ArticleTitle', 'Sentence'])
+
+
+def extract_law_texts(law):
+    """
+    法令オブジェクトから LAW_TEXT_FIELDS のテキストを文書順に抽出する。
+    再帰せず、イテレータのスタックで1回だけ走査する。
+    """
+    texts = []
+    stack = [iter(law.items())]
+    while stack:
+        for key, value in stack[-1]:
+            if key in LAW_TEXT_FIELDS and isinstance(value, str):
+                texts.append(value)
+            elif isinstance(value, dict):
+                stack.append(iter(value.items()))
+                break
+            elif isinstance(value, list):
+                # リスト内の辞書だけを辿る（文字列の要素は対象外）
+                stack.append((None, item) for item in value if isinstance(item, dict))
+                break
+        else:
+            stack.pop()
+    return texts
+
+
+def make_law_record(entry):
+    """law JSONの1要素から、LawNum・題名と抽出テキストをまとめたレコードを作る"""
+    law = entry.get("Law", entry)
+    law_title = law.get("LawBody", {}).get("LawTitle", {})
+    if not isinstance(law_title, dict):
+        law_title = {'#text': law_title}
+    return {
+        'law_num': law.get("LawNum"),
+        'law_title': law_title.get("@Abbrev"),
+        'law_text': law_title.get("#text"),
+        'texts': extract_law_texts(entry),
+    }
+
+
+def source_signature(path):
+    stat = os.stat(path)
+    return {'source': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'fields': sorted(LAW_TEXT_FIELDS)}
+
+
+def write_law_text_file(text_file, records, signature):
+    """先頭行に元ファイルの情報、以降に1行1法令のレコードを書くJSONL"""
+    text_dir = os.path.dirname(text_file)
+    if text_dir:
+        os.makedirs(text_dir, exist_ok=True)
+    with open(text_file + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'_meta': signature}, ensure_ascii=False) + '\n')
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    os.replace(text_file + '.tmp', text_file)
+
+
+def read_law_text_file(text_file, signature):
+    """元ファイルが変わっていなければレコードを返す。作り直しが必要ならNone"""
+    if not os.path.exists(text_file):
+        return None
+    with open(text_file, 'r', encoding='utf-8') as f:
+        try:
+            meta = json.loads(f.readline()).get('_meta')
+        except json.JSONDecodeError:
+            return None
+        if meta != signature:
+            return None
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_law_texts(law_json_path, text_file=None, data=None):
+    """
+    法令ごとの抽出テキストのレコードを返す。
+    text_file が最新ならそれを読むだけで、法令JSONの読み込みと走査は行わない。
+    古い・無い場合は法令JSON（読み込み済みなら data）から作り、text_file に保存する。
+    """
+    signature = source_signature(law_json_path)
+    if text_file:
+        records = read_law_text_file(text_file, signature)
+        if records is not None:
+            logging.info(f"抽出済みテキストを使用します: {text_file} ({len(records)}件)")
+            return records
+
+    if data is None:
+        with open(law_json_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    records = [make_law_record(entry) for entry in data]
+    if text_file:
+        write_law_text_file(text_file, records, signature)
+        logging.info(f"抽出テキストを保存しました: {text_file} ({len(records)}件)")
+    return records
@@ -0,0 +1,67 @@
+import time
+import random
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class RateLimiter:
+    """1秒あたりのリクエスト数を制限する（スレッドセーフ）。rateが0/Noneなら無制限"""
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def call_with_retry(func, max_retries=3, backoff=1.0, max_backoff=30.0, description="request"):
+    """
+    例外が発生したら指数バックオフ（ジッター付き）で再試行する。
+    max_retries回再試行しても失敗した場合は最後の例外を送出する。
+    """
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= max_retries:
+                raise
+            delay = min(max_backoff, backoff * (2 ** attempt)) * random.uniform(0.5, 1.0)
+            attempt += 1
+            logging.warning(f"{description} に失敗したため {delay:.1f}秒後に再試行します ({attempt}/{max_retries}): {e}")
+            time.sleep(delay)
+
+
+def run_ordered(func, items, max_in_flight=1, on_result=None):
+    """
+    itemsの各要素にfuncを同時実行数max_in_flightで適用し、入力順の結果リストを返す。
+    on_result(index, result) は完了した順に呼ばれる（呼び出し元のスレッドで実行）。
+    funcは呼び出し元のcontextvarsを引き継いだワーカースレッドで実行される（ステップの計測値を加算できるように）。
+    """
+    results = [None] * len(items)
+    if max_in_flight <= 1:
+        for index, item in enumerate(items):
+            results[index] = func(item)
+            if on_result:
+                on_result(index, results[index])
+        return results
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        futures = {executor.submit(contextvars.copy_context().run, func, item): index for index, item in enumerate(items)}
+        for future in as_completed(futures):
+            index = futures[future]
+            results[index] = future.result()
+            if on_result:
+                on_result(index, results[index])
+    return results
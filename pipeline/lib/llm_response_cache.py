@@ -0,0 +1,124 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+# 参照日時の更新をまとめて書き込む件数（ヒットのたびにcommitしない）
+ACCESS_FLUSH_EVERY = 200
+
+def sha256_text(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class LlmResponseCache:
+    """
+    LLMの応答をSQLiteに保存する永続キャッシュ。
+    キーは (モデル名, 応答の用途, LLMに送る最終的なプロンプトのハッシュ)。
+    用途（'summary', 'tags' など）を含めるので、同じモデル・プロンプト・内容でも応答の形式が違うステップ同士で混ざらない。
+    合計サイズがmax_bytesを超えたら、最後に参照された時刻が古いものから削除する。
+    ヒットした時の参照日時はメモリに溜め、ACCESS_FLUSH_EVERY件ごと・put・close の時にまとめて書き込む。
+    """
+
+    def __init__(self, db_path, max_bytes=None):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER,"
+            " latency REAL, created REAL, accessed REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.saved_latency = 0.0
+        # {key: 参照日時}（まだ書き込んでいないもの）
+        self.pending_access = {}
+
+    @staticmethod
+    def make_key(model, purpose, prompt):
+        """purpose: 応答の用途・形式（'summary' など） / prompt: LLMに送る最終的なプロンプト"""
+        return sha256_text(f"{model}\x1f{purpose}\x1f{sha256_text(prompt)}")
+
+    def get(self, key):
+        """キャッシュ済みの応答を返す。無ければNone"""
+        with self.lock:
+            row = self.conn.execute("SELECT response, latency FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.pending_access[key] = time.time()
+            if len(self.pending_access) >= ACCESS_FLUSH_EVERY:
+                self.flush_access()
+                self.conn.commit()
+            self.hits += 1
+            self.saved_latency += row[1] or 0.0
+            return row[0]
+
+    def put(self, key, model, response, latency):
+        size = len(response.encode('utf-8'))
+        now = time.time()
+        with self.lock:
+            self.flush_access()
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, latency, created, accessed)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, response, size, latency, now, now)
+            )
+            self.total_bytes += size - (old[0] if old else 0)
+            if self.max_bytes and self.total_bytes > self.max_bytes:
+                self.evict()
+            self.conn.commit()
+
+    def flush_access(self):
+        """溜めた参照日時を書き込む（lock取得済みで呼ぶこと。commitは呼び出し側で行う）"""
+        if self.pending_access:
+            self.conn.executemany("UPDATE responses SET accessed = ? WHERE key = ?",
+                                  [(accessed, key) for key, accessed in self.pending_access.items()])
+            self.pending_access = {}
+
+    def evict(self):
+        """古いものから削除し、上限の9割まで減らす（lock取得済みで呼ぶこと）"""
+        target = self.max_bytes * 0.9
+        removed = 0
+        rows = self.conn.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.total_bytes -= size
+            removed += 1
+        logging.info(f"LLM応答キャッシュから{removed}件を削除しました (合計 {self.total_bytes / 1024 / 1024:.1f}MB)")
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        logging.info(
+            f"LLM応答キャッシュ: hit={self.hits}, miss={self.misses} ({hit_rate:.1f}%), "
+            f"節約した応答待ち時間: {self.saved_latency:.1f}秒"
+        )
+
+    def close(self):
+        with self.lock:
+            self.flush_access()
+            self.conn.commit()
+            self.conn.close()
+
+
+def open_response_cache(step_config):
+    """ステップ設定の llm_cache_file / llm_cache_max_mb からキャッシュを開く（未指定ならNone）"""
+    cache_file = step_config.get('llm_cache_file')
+    if not cache_file:
+        return None
+    max_mb = step_config.get('llm_cache_max_mb')
+    return LlmResponseCache(cache_file, int(float(max_mb) * 1024 * 1024) if max_mb else None)
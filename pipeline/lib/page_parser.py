@@ -0,0 +1,165 @@
+import re
+import codecs
+from html.parser import HTMLParser
+
+import chardet
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+
+# <meta charset="..."> / <meta http-equiv="Content-Type" content="...; charset=..."> を探す範囲（HTML仕様では先頭1024バイト）
+META_SNIFF_BYTES = 4096
+# chardetに渡すサンプルの大きさ（全文を渡すと大きなページで非常に遅い）
+CHARDET_SAMPLE_BYTES = 32 * 1024
+
+CHARSET_RE = re.compile(rb'charset\s*=\s*["\']?\s*([A-Za-z0-9_.:-]+)', re.IGNORECASE)
+META_RE = re.compile(rb'<meta[^>]+>', re.IGNORECASE)
+HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+# テキスト抽出で後ろに改行を入れる要素
+BLOCK_TAGS = frozenset([
+    'p', 'div', 'br', 'li', 'ul', 'ol', 'dl', 'dt', 'dd', 'tr', 'table', 'section', 'article',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'pre', 'blockquote', 'caption', 'th', 'td',
+])
+
+
+def normalize_charset(name):
+    """Pythonで使える文字コード名にする（不明ならNone）"""
+    if not name:
+        return None
+    if isinstance(name, bytes):
+        name = name.decode('ascii', 'ignore')
+    try:
+        return codecs.lookup(name.strip().strip('"\'')).name
+    except LookupError:
+        return None
+
+
+def header_charset(content_type):
+    match = CHARSET_RE.search((content_type or '').encode('latin-1', 'ignore'))
+    return normalize_charset(match.group(1)) if match else None
+
+
+def meta_charset(content):
+    head = content[:META_SNIFF_BYTES]
+    for meta in META_RE.findall(head):
+        match = CHARSET_RE.search(meta)
+        if match:
+            return normalize_charset(match.group(1))
+    return None
+
+
+def detect_encoding(content, content_type=''):
+    """
+    ページの文字コードを Content-Typeヘッダー → <meta> → chardet（先頭の一部だけ）の順に決める。
+    どれでも決まらなければ utf-8。
+    """
+    if content.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    encoding = header_charset(content_type) or meta_charset(content)
+    if encoding:
+        return encoding
+    detected = chardet.detect(content[:CHARDET_SAMPLE_BYTES])['encoding']
+    return normalize_charset(detected) or 'utf-8'
+
+
+def decode_html(content, content_type=''):
+    """(テキスト, 文字コード) を返す。宣言と違うバイト列が混ざっていても置換文字にして読み進める"""
+    encoding = detect_encoding(content, content_type)
+    return content.decode(encoding, errors='replace'), encoding
+
+
+def is_html(content_type, url=''):
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type:
+        return content_type in HTML_CONTENT_TYPES
+    return url.lower().split('?')[0].endswith(('.html', '.htm', '/'))
+
+
+def is_text(content_type):
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    return content_type.startswith('text/') or content_type in HTML_CONTENT_TYPES
+
+
+class LinkExtractor(HTMLParser):
+    """<a href> だけを集めるHTMLParser（lxmlが無い場合に使う。木を作らない）"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            for name, value in attrs:
+                if name == 'href' and value:
+                    self.links.append(value)
+
+
+def extract_hrefs(html):
+    """HTML中の <a href> の値を文書順に返す（lxmlがあればlxml、無ければHTMLParser）"""
+    if lxml is not None:
+        try:
+            document = lxml.html.fromstring(html)
+        except (ValueError, lxml.etree.ParserError):
+            # 空の文書や、encoding宣言付きのstrなどはHTMLParserで読む
+            document = None
+        if document is not None:
+            return [href for href in document.xpath('//a/@href') if href]
+    extractor = LinkExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return extractor.links
+
+
+def clean_text(text):
+    """行ごとに空白をまとめ、空行を除く"""
+    lines = (" ".join(line.split()) for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def extract_element_text(html, element_id='contents'):
+    """
+    id=element_id の要素のテキストだけ（タグ・属性・script/styleを除く）を返す。要素が無ければNone。
+    LLMに渡すプロンプトからマークアップを除くために使う。
+    """
+    if lxml is not None:
+        try:
+            document = lxml.html.fromstring(html)
+        except (ValueError, lxml.etree.ParserError):
+            document = None
+        if document is not None:
+            elements = document.xpath('//*[@id=$element_id]', element_id=element_id)
+            if not elements:
+                return None
+            element = elements[0]
+            for node in element.xpath('.//script|.//style|.//noscript'):
+                node.drop_tree()
+            # ブロック要素の区切りが行になるよう、要素の末尾で改行する
+            for node in element.iter():
+                if isinstance(node.tag, str) and node.tag in BLOCK_TAGS:
+                    node.tail = "\n" + (node.tail or "")
+            return clean_text(element.text_content())
+
+    from bs4 import BeautifulSoup
+    element = BeautifulSoup(html, 'html.parser').find(id=element_id)
+    if element is None:
+        return None
+    for node in element.find_all(['script', 'style', 'noscript']):
+        node.decompose()
+    return clean_text(element.get_text("\n"))
+
+
+def extract_file_contents(file_path, mode='text', element_id='contents'):
+    """
+    保存済みHTMLファイルから div#element_id を取り出す（プロセスプールのワーカーで実行するので、このモジュールだけで完結させる）。
+    text: タグ・属性を除いたテキスト / html: divのHTMLそのもの。どちらもdivが無ければNone。
+    """
+    with open(file_path, 'r', encoding='utf-8') as file:
+        html = file.read()
+    if mode == 'html':
+        from bs4 import BeautifulSoup
+        element = BeautifulSoup(html, 'html.parser').find('div', id=element_id)
+        return str(element) if element is not None else None
+    return extract_element_text(html, element_id)
@@ -0,0 +1,124 @@
+import numpy as np
+
+
+def normalize_rows(matrix):
+    """行ベクトルをL2正規化したfloat32配列を返す（内積 = コサイン類似度になる）"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix[None, :]
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k(scores, k):
+    """各行のスコア上位k件の (インデックス, スコア) を降順で返す"""
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty.astype(np.int64), empty.astype(np.float32)
+    if k < scores.shape[1]:
+        idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    part = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-part, axis=1, kind='stable')
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+
+class SimilarityIndex:
+    """正規化済みベクトルに対する全件（厳密）コサイン類似度検索"""
+
+    def __init__(self, embeddings, block_size=16384):
+        self.vectors = normalize_rows(embeddings)
+        self.block_size = block_size
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def search(self, query, k=10):
+        indices, scores = self.search_batch(query, k)
+        return indices[0], scores[0]
+
+    def search_batch(self, queries, k=10, query_block=256):
+        """
+        複数クエリの上位k件を求める。
+        クエリ・コーパスともにブロック単位で行列積を取り、ブロックごとの上位k件をマージする。
+        """
+        queries = normalize_rows(queries)
+        k = min(k, len(self))
+        all_indices = np.zeros((queries.shape[0], k), dtype=np.int64)
+        all_scores = np.zeros((queries.shape[0], k), dtype=np.float32)
+
+        for q_start in range(0, queries.shape[0], query_block):
+            q = queries[q_start:q_start + query_block]
+            best_idx = np.empty((q.shape[0], 0), dtype=np.int64)
+            best_scores = np.empty((q.shape[0], 0), dtype=np.float32)
+            for v_start in range(0, len(self), self.block_size):
+                block = self.vectors[v_start:v_start + self.block_size]
+                idx, scores = top_k(q @ block.T, k)
+                cand_idx = np.concatenate([best_idx, idx + v_start], axis=1)
+                cand_scores = np.concatenate([best_scores, scores], axis=1)
+                sel, best_scores = top_k(cand_scores, k)
+                best_idx = np.take_along_axis(cand_idx, sel, axis=1)
+            all_indices[q_start:q_start + q.shape[0]] = best_idx
+            all_scores[q_start:q_start + q.shape[0]] = best_scores
+        return all_indices, all_scores
+
+
+class IvfIndex(SimilarityIndex):
+    """
+    転置ファイル（IVF）による近似検索。
+    球面k-meansでベクトルをクラスタに分け、クエリに近いn_probe個のクラスタ内だけを探索する。
+    """
+
+    def __init__(self, embeddings, n_lists=None, n_probe=8, n_iter=10, seed=0, block_size=16384):
+        super().__init__(embeddings, block_size=block_size)
+        n = len(self)
+        self.n_lists = max(1, min(n, n_lists or int(np.sqrt(n))))
+        self.n_probe = min(n_probe, self.n_lists)
+        self.centroids = self.train(n_iter, seed)
+        assignments = self.assign(self.vectors)
+        order = np.argsort(assignments, kind='stable')
+        bounds = np.searchsorted(assignments[order], np.arange(self.n_lists + 1))
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(self.n_lists)]
+
+    def assign(self, vectors):
+        """各ベクトルを最も近いセントロイドに割り当てる"""
+        assignments = np.empty(vectors.shape[0], dtype=np.int64)
+        for start in range(0, vectors.shape[0], self.block_size):
+            block = vectors[start:start + self.block_size]
+            assignments[start:start + block.shape[0]] = np.argmax(block @ self.centroids.T, axis=1)
+        return assignments
+
+    def train(self, n_iter, seed):
+        rng = np.random.default_rng(seed)
+        n = len(self)
+        # 学習は最大でクラスタ数の256倍のサンプルで行う
+        sample = self.vectors[rng.choice(n, size=min(n, self.n_lists * 256), replace=False)]
+        self.centroids = sample[rng.choice(sample.shape[0], size=self.n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assignments = self.assign(sample)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assignments, sample)
+            empty = np.linalg.norm(sums, axis=1) == 0
+            # 空になったクラスタはランダムなサンプルで置き直す
+            sums[empty] = sample[rng.choice(sample.shape[0], size=int(empty.sum()))]
+            self.centroids = normalize_rows(sums)
+        return self.centroids
+
+    def search_batch(self, queries, k=10, query_block=256):
+        queries = normalize_rows(queries)
+        k = min(k, len(self))
+        all_indices = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        all_scores = np.full((queries.shape[0], k), -np.inf, dtype=np.float32)
+
+        probes, _ = top_k(queries @ self.centroids.T, self.n_probe)
+        for i, query in enumerate(queries):
+            candidates = np.concatenate([self.lists[c] for c in probes[i]])
+            if candidates.size == 0:
+                continue
+            idx, scores = top_k((self.vectors[candidates] @ query)[None, :], k)
+            all_indices[i, :idx.shape[1]] = candidates[idx[0]]
+            all_scores[i, :idx.shape[1]] = scores[0]
+        return all_indices, all_scores
@@ -0,0 +1,120 @@
+import time
+import random
+import logging
+import unicodedata
+from collections import Counter, defaultdict
+
+
+def normalize_tag(tag):
+    """全角/半角・大文字/小文字・空白や記号の違いを吸収した比較用の文字列"""
+    text = unicodedata.normalize('NFKC', str(tag)).lower()
+    normalized = "".join(ch for ch in text if ch.isalnum())
+    return normalized or text.strip()
+
+
+def char_ngrams(text, n=2):
+    """前後に境界記号を付けた文字n-gramの集合（1文字のタグでもn-gramができる）"""
+    padded = f"^{text}$"
+    return {padded[i:i + n] for i in range(max(1, len(padded) - n + 1))}
+
+
+class TagConsolidator:
+    """
+    類似したタグを1つの代表タグにまとめる。
+    1. 正規化後に同じ文字列になるタグを統合
+    2. 出現回数の多い順に、文字n-gramのDice係数がthreshold以上の既存クラスタへ割り当て（無ければ新しいクラスタ）
+    3. クラスタ数がtarget_sizeを超える場合、上位target_size個を語彙とし、残りを最も近い語彙へ割り当て
+       （n-gramを共有する語彙が無いクラスタは最も多く使われた語彙へ寄せるので、代表タグは必ずtarget_size個以下になる）
+    n-gramの転置インデックスで候補クラスタだけを比較するので、タグ数に対してほぼ線形で動く。
+    """
+
+    def __init__(self, target_size=15, threshold=0.5, ngram=2, max_postings=1000):
+        self.target_size = target_size
+        self.threshold = threshold
+        self.ngram = ngram
+        # 多くのクラスタに共通するn-gramは候補探索に使わない（計算量を抑えるため）
+        self.max_postings = max_postings
+
+    def nearest(self, grams, index, cluster_grams):
+        """転置インデックスからn-gramを共有するクラスタを集め、Dice係数が最大のものを返す"""
+        overlap = Counter()
+        for gram in grams:
+            postings = index.get(gram)
+            if postings and len(postings) <= self.max_postings:
+                overlap.update(postings)
+        best, best_score = None, 0.0
+        for cluster, shared in overlap.items():
+            score = 2 * shared / (len(grams) + len(cluster_grams[cluster]))
+            if score > best_score:
+                best, best_score = cluster, score
+        return best, best_score
+
+    def consolidate(self, tag_count):
+        """タグ→代表タグ の対応表を返す"""
+        # 1. 正規化で同一になるタグをまとめる（代表は最も多く使われた表記）
+        groups = defaultdict(Counter)
+        for tag, count in tag_count.items():
+            groups[normalize_tag(tag)][tag] += count
+        ordered = sorted(groups.items(), key=lambda item: (-sum(item[1].values()), item[0]))
+
+        # 2. 出現回数の多い順に、近いクラスタへ割り当てる
+        cluster_labels = []
+        cluster_grams = []
+        cluster_counts = []
+        group_cluster = {}
+        index = defaultdict(list)
+        for normalized, variants in ordered:
+            grams = char_ngrams(normalized, self.ngram)
+            cluster, score = self.nearest(grams, index, cluster_grams)
+            if cluster is None or score < self.threshold:
+                cluster = len(cluster_labels)
+                cluster_labels.append(variants.most_common(1)[0][0])
+                cluster_grams.append(grams)
+                cluster_counts.append(0)
+                for gram in grams:
+                    index[gram].append(cluster)
+            cluster_counts[cluster] += sum(variants.values())
+            group_cluster[normalized] = cluster
+
+        # 3. クラスタ数が多すぎる場合は、上位クラスタを語彙として残りを寄せる
+        cluster_target = list(range(len(cluster_labels)))
+        if len(cluster_labels) > self.target_size:
+            ranked = sorted(range(len(cluster_labels)), key=lambda c: (-cluster_counts[c], c))
+            vocabulary = ranked[:self.target_size]
+            vocab_index = defaultdict(list)
+            for cluster in vocabulary:
+                for gram in cluster_grams[cluster]:
+                    vocab_index[gram].append(cluster)
+            for cluster in ranked[self.target_size:]:
+                nearest, _ = self.nearest(cluster_grams[cluster], vocab_index, cluster_grams)
+                # 短いタグは語彙とn-gramを共有しないことが多い。その場合は最も多く使われた語彙へ寄せる
+                cluster_target[cluster] = nearest if nearest is not None else vocabulary[0]
+
+        mapping = {}
+        for normalized, variants in groups.items():
+            label = cluster_labels[cluster_target[group_cluster[normalized]]]
+            for tag in variants:
+                mapping[tag] = label
+        logging.info(f"タグ統合: {len(tag_count)}種類 → {len(set(mapping.values()))}種類")
+        return mapping
+
+
+def benchmark(sizes=(1000, 10000, 50000), target_size=15):
+    """合成したタグ語彙で処理時間を計測する"""
+    rng = random.Random(0)
+    alphabet = "建築住宅安全都市計画防災土地道路環境手続補助許可申請基準管理保全"
+    for size in sizes:
+        stems = ["".join(rng.choice(alphabet) for _ in range(rng.randint(2, 5))) for _ in range(size // 5 or 1)]
+        tag_count = Counter()
+        while len(tag_count) < size:
+            # 語幹に接尾辞・全角/半角・空白などの揺れを加える
+            tag = rng.choice(stems) + rng.choice(["", "制度", "法", "等", " ", "Ａ", "a", str(rng.randint(0, 99))])
+            tag_count[tag] += rng.randint(1, 20)
+        start = time.perf_counter()
+        mapping = TagConsolidator(target_size=target_size).consolidate(tag_count)
+        elapsed = time.perf_counter() - start
+        print(f"{size:>6d} tags -> {len(set(mapping.values()))} labels: {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    benchmark()
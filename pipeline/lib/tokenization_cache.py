@@ -0,0 +1,53 @@
+import os
+import sqlite3
+import hashlib
+
+
+class TokenizationCache:
+    """
+    文 → 分かち書き結果 の永続キャッシュ（SQLite）。
+    法令には同じ文（制定文や条見出しなど）が繰り返し現れるため、内容のハッシュをキーにする。
+    """
+
+    def __init__(self, db_path, namespace=""):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        # 分かち書きの設定が変わったら別のキーになるようにする
+        self.namespace = namespace
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS tokens (key TEXT PRIMARY KEY, tokens TEXT)")
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, text):
+        return hashlib.sha1(f"{self.namespace}\x1f{text}".encode('utf-8')).hexdigest()
+
+    def get_many(self, texts):
+        """キャッシュにある分だけ {text: tokens} で返す"""
+        keys = {self.make_key(text): text for text in texts}
+        found = {}
+        key_list = list(keys)
+        for start in range(0, len(key_list), 500):
+            chunk = key_list[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for key, tokens in self.conn.execute(f"SELECT key, tokens FROM tokens WHERE key IN ({placeholders})", chunk):
+                found[keys[key]] = tokens
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, tokenized):
+        """{text: tokens} をまとめて保存する"""
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO tokens (key, tokens) VALUES (?, ?)",
+            ((self.make_key(text), tokens) for text, tokens in tokenized.items())
+        )
+        self.conn.commit()
+
+    def close(self):
+        """未確定の書き込みを確定して閉じる（ステップが失敗した場合も呼ぶ）"""
+        self.conn.commit()
+        self.conn.close()
@@ -1,8 +1,14 @@
 import os
 import json
+import time
 import logging
 from collections import Counter
 from openai import OpenAI
+from lib.llm_request_pool import RateLimiter, call_with_retry, run_ordered
+from lib.llm_response_cache import open_response_cache
+from lib.checkpoint import JsonlCheckpoint, checkpoint_key
+from lib.tag_consolidator import TagConsolidator
+import pipeline_metrics
 
 # ロギングの設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -16,7 +22,26 @@ class LlmTagStep:
         self.llm_model = step_config['llm_model']
         llm_prompt_file = step_config['llm_prompt_file']
         llm_prompt = self.load_llm_prompt(llm_prompt_file)
-        self.ollama_client = OllamaClient(self.llm_url, self.llm_api_key, self.llm_model, llm_prompt)
+        # 同時リクエスト数（1なら従来通り1件ずつ）
+        self.llm_max_in_flight = int(step_config.get('llm_max_in_flight', 1))
+        self.ollama_client = OllamaClient(
+            self.llm_url, self.llm_api_key, self.llm_model, llm_prompt,
+            timeout=step_config.get('llm_timeout'),
+            max_retries=int(step_config.get('llm_max_retries', 2)),
+            retry_backoff=float(step_config.get('llm_retry_backoff', 1.0)),
+            requests_per_second=step_config.get('llm_requests_per_second'),
+            response_cache=open_response_cache(step_config),
+        )
+        # 完了したタグ付け結果を逐次追記し、中断後はその続きから再開する
+        self.checkpoint = JsonlCheckpoint(
+            step_config.get('checkpoint_file', f"{self.output_json_path}.checkpoint.jsonl"),
+            fsync_every=step_config.get('checkpoint_fsync_every', 50),
+        )
+        self.checkpoint_results = {}
+        self.tag_consolidator = TagConsolidator(
+            target_size=int(step_config.get('tag_vocab_size', 15)),
+            threshold=float(step_config.get('tag_similarity_threshold', 0.5)),
+        )
         self.tag_count = Counter()
 
     def load_llm_prompt(self, llm_prompt_file):
@@ -43,53 +68,84 @@ class LlmTagStep:
 
     def first_tagging(self, data):
         """ 1回目のタグ付け: 各Lawにタグを付与し、タグの参照回数を記録 """
-        for entry in data:
-            law_content = json.dumps(entry.get("Law", {}), ensure_ascii=False)
-            if law_content:
-                entry["tags"] = self.ollama_client.create_tags(law_content)
-                self.tag_count.update(entry["tags"])
+        contents = [json.dumps(entry.get("Law", {}), ensure_ascii=False) for entry in data]
+        keys = [checkpoint_key(index, content) for index, content in enumerate(contents)]
+        tags_list = [None] * len(contents)
+        for index, key in enumerate(keys):
+            tags_list[index] = self.checkpoint_results.get(key)
+        pending = [index for index, tags in enumerate(tags_list) if tags is None]
+
+        def on_result(position, tags):
+            index = pending[position]
+            tags_list[index] = tags
+            # 失敗時も空リストが返るため、空の結果は記録せず再開時に再実行する
+            if tags:
+                self.checkpoint.append(keys[index], tags)
+
+        start = time.perf_counter()
+        # 結果は入力順で返るので、同時実行しても出力とタグの集計順は変わらない
+        run_ordered(self.ollama_client.create_tags, [contents[index] for index in pending], self.llm_max_in_flight, on_result)
+        elapsed = time.perf_counter() - start
+        self.checkpoint.close()
+        for entry, tags in zip(data, tags_list):
+            entry["tags"] = tags
+            self.tag_count.update(tags)
+        logging.info(f"LLM呼び出し: {len(pending)}件 (再開でスキップ: {len(contents) - len(pending)}件), {elapsed:.1f}秒, {len(pending) / max(elapsed, 1e-9):.2f}件/秒 (同時実行数: {self.llm_max_in_flight})")
         logging.info(f"1回目のタグ付け完了。使用されたタグ数: {len(self.tag_count)}")
         return data
 
     def refine_tags(self, data):
-        """ タグの統一処理を繰り返し、15個以下になるか10回実行する """
-        iterations = 0
-        while len(self.tag_count) > 15 and iterations < 10:
-            tag_mapping = {tag: max(self.tag_count, key=self.tag_count.get) for tag in self.tag_count}
-            for entry in data:
-                entry["tags"] = [tag_mapping.get(tag, tag) for tag in entry["tags"]]
-            self.tag_count = Counter(tag for entry in data for tag in entry["tags"])
-            iterations += 1
-            logging.info(f"{iterations}回目のタグ統一処理完了。使用されているタグ数: {len(self.tag_count)}")
+        """ 類似したタグを代表タグにまとめ、タグの種類をtag_vocab_size個以下に統一する """
+        tag_mapping = self.tag_consolidator.consolidate(self.tag_count)
+        for entry in data:
+            # まとめた結果同じタグになったものは1つにする
+            entry["tags"] = list(dict.fromkeys(tag_mapping.get(tag, tag) for tag in entry["tags"]))
+        self.tag_count = Counter(tag for entry in data for tag in entry["tags"])
+        logging.info(f"タグ統一処理完了。使用されているタグ数: {len(self.tag_count)}")
         return data
 
     def execute(self):
         data = self.load_data()
+        self.checkpoint_results = self.checkpoint.load()
         data = self.first_tagging(data)
         data = self.refine_tags(data)
         self.save_data(data)
+        # 最終出力を書き終えたらチェックポイントは不要
+        self.checkpoint.remove()
+        pipeline_metrics.add_items(len(data))
+        if self.ollama_client.response_cache:
+            self.ollama_client.response_cache.log_stats()
+            pipeline_metrics.incr('llm_cache_hits', self.ollama_client.response_cache.hits)
+            pipeline_metrics.incr('llm_cache_misses', self.ollama_client.response_cache.misses)
+            # 溜まっている参照日時を書き込んで閉じる
+            self.ollama_client.response_cache.close()
 
 
 class OllamaClient:
-    def __init__(self, llm_url, llm_api_key, llm_model, llm_prompt):
+    def __init__(self, llm_url, llm_api_key, llm_model, llm_prompt, timeout=None, max_retries=2, retry_backoff=1.0, requests_per_second=None, response_cache=None):
         self.llm_url = llm_url
         self.llm_api_key = llm_api_key
         self.llm_model = llm_model
         self.llm_prompt = llm_prompt
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.rate_limiter = RateLimiter(float(requests_per_second) if requests_per_second else None)
+        self.response_cache = response_cache
         logging.info(f"LLM prompt : {llm_prompt}")
-        # OpenAIクライアントのセットアップ
+        # OpenAIクライアントのセットアップ（再試行はcall_with_retryで行う）
+        client_options = {'timeout': float(timeout)} if timeout else {}
         self.client = OpenAI(
             base_url=self.llm_url,
             api_key=self.llm_api_key,
+            max_retries=0,
+            **client_options,
         )
 
-    def exp_tags(self, response):
-        lines = response.splitlines()
-        tags = [line for line in lines if "tags" in line][0]
-        return "{" + tags + "}"
-    def create_tags(self, content):
-        try:
-            prompt = f"{self.llm_prompt}\n{content}\nJSON:"
+    def chat(self, prompt):
+        """レート制限・指数バックオフ付きでチャット補完を呼び出し、応答テキストを返す"""
+        def request():
+            self.rate_limiter.acquire()
+            pipeline_metrics.incr('llm_calls')
             chat_completion = self.client.chat.completions.create(
                 model=self.llm_model,
                 messages=[
@@ -100,10 +156,31 @@ class OllamaClient:
                     }
                 ]
             )
-            response = chat_completion.choices[0].message.content
-            logging.info(f"Raw LLM response: {response}")
-            response = self.exp_tags(response)
-            tags = json.loads(response).get("tags", [])
+            return chat_completion.choices[0].message.content
+        return call_with_retry(request, self.max_retries, self.retry_backoff, description="LLMの呼び出し")
+
+    def exp_tags(self, response):
+        lines = response.splitlines()
+        tags = [line for line in lines if "tags" in line][0]
+        return "{" + tags + "}"
+    def create_tags(self, content):
+        try:
+            cache_key = None
+            latency = None
+            response = None
+            prompt = f"{self.llm_prompt}\n{content}\nJSON:"
+            if self.response_cache:
+                cache_key = self.response_cache.make_key(self.llm_model, 'tags', prompt)
+                response = self.response_cache.get(cache_key)
+            if response is None:
+                start = time.perf_counter()
+                response = self.chat(prompt)
+                latency = time.perf_counter() - start
+                logging.info(f"Raw LLM response: {response}")
+            tags = json.loads(self.exp_tags(response)).get("tags", [])
+            # 解析できた応答だけをキャッシュする（不正な応答は次回再取得）
+            if cache_key and latency is not None:
+                self.response_cache.put(cache_key, self.llm_model, response, latency)
             logging.info("LLMの応答を受信しました")
             return tags
         except (json.JSONDecodeError, KeyError):
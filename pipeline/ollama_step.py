@@ -2,14 +2,31 @@ import os
 import json
 import yaml
 import hashlib
+import time
+import argparse
+import tempfile
+import threading
+import contextvars
+import multiprocessing
+from functools import partial
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import pandas as pd
-from bs4 import BeautifulSoup
 from openai import OpenAI
+from lib.llm_request_pool import RateLimiter, call_with_retry
+from lib.llm_response_cache import open_response_cache
+from lib.page_parser import extract_file_contents
+from lib.checkpoint import JsonlCheckpoint, checkpoint_key
+import pipeline_metrics
+from lib.crawl_frontier import canonicalize_url
+from lib.crawl_state import CrawlState
 import logging
 
 # ロギングの設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# 要約するページ（data内の位置、URL、保存済みHTMLのパス）
+PageJob = namedtuple('PageJob', ['index', 'url', 'file_path'])
 
 
 class OllamaStep:
@@ -17,11 +34,19 @@ class OllamaStep:
         self.progress_data = None
         self.url_to_filepath = None
         # URLに対応するHTML（スクレイピングで取得したもの）
-        self.progress_file_path = step_config['progress_file']
+        self.progress_file_path = step_config.get('progress_file', '')
+        # スクレイピングの進行状況のSQLite（指定時はURLごとに検索し、progress_fileは読み込まない）
+        # 読み取り専用で開く（無ければ FileNotFoundError）
+        crawl_state_db = step_config.get('crawl_state_db')
+        self.crawl_state = CrawlState(crawl_state_db, read_only=True) if crawl_state_db else None
         # 入力：「概要」再作成対象のサービスカタログjson
         self.input_json_path = step_config['input_json_file']
         # 出力：「概要」再作成したサービスカタログの出力先
         self.output_json_path = step_config['output_json_file']
+        # スクレイピングで新規取得・変更されたURLの一覧（crawl_state_dbが無い場合に使う）。処理が終わったら空にする
+        self.changed_urls_file = step_config.get('changed_urls_file', '')
+        # 前回の実行の記録（開始日時・モデル・プロンプト）。これ以降に変わっていないページは前回の「概要」を引き継ぐ
+        self.summary_state_file = step_config.get('summary_state_file', f"{self.output_json_path}.state.json")
 
         # LLMの設定
         self.llm_url = step_config['llm_url']
@@ -29,7 +54,26 @@ class OllamaStep:
         self.llm_model = step_config['llm_model']
         llm_prompt_file = step_config['llm_prompt_file']
         llm_prompt = self.load_llm_prompt(llm_prompt_file)
-        self.ollama_client = OllamaClient(self.llm_url, self.llm_api_key, self.llm_model, llm_prompt)
+        self.ollama_client = OllamaClient(
+            self.llm_url, self.llm_api_key, self.llm_model, llm_prompt,
+            timeout=step_config.get('llm_timeout'),
+            max_retries=int(step_config.get('llm_max_retries', 2)),
+            retry_backoff=float(step_config.get('llm_retry_backoff', 1.0)),
+            requests_per_second=step_config.get('llm_requests_per_second'),
+            response_cache=open_response_cache(step_config),
+        )
+        # LLMに渡す本文（text: div#contentsのテキストのみ / html: divのHTMLそのもの）
+        self.summary_input = step_config.get('summary_input', 'text')
+        # HTMLからの本文抽出のプロセス数と、LLMの同時呼び出し数
+        self.extract_workers = int(step_config.get('extract_workers', 1))
+        self.llm_max_in_flight = int(step_config.get('llm_max_in_flight', 1))
+        # 抽出を始めてから要約が終わるまでの間に持てるページ数の上限（LLMが遅いときに抽出だけが先に進まないように）
+        self.pipeline_queue_size = max(1, int(step_config.get('pipeline_queue_size', 2 * self.llm_max_in_flight + self.extract_workers)))
+        # 完了した要約を逐次追記し、中断後はその続きから再開する
+        self.checkpoint = JsonlCheckpoint(
+            step_config.get('checkpoint_file', f"{self.output_json_path}.checkpoint.jsonl"),
+            fsync_every=step_config.get('checkpoint_fsync_every', 50),
+        )
 
     def load_llm_prompt(self, llm_prompt_file):
         try:
@@ -51,12 +95,16 @@ class OllamaStep:
                 self.progress_data = json.load(file)
             self.url_to_filepath = self.progress_data.get("visited", {})
 
-    def get_file_content(self, url):
-        """Retrieve content from file corresponding to the URL."""
+    def lookup_file_path(self, url):
+        """Find the scraped file for the URL (the scraper stores canonicalized URLs)."""
+        if self.crawl_state:
+            return self.crawl_state.lookup(url) or self.crawl_state.lookup(canonicalize_url(url))
         self.load_progress()  # Ensure progress file is loaded
+        return self.url_to_filepath.get(url) or self.url_to_filepath.get(canonicalize_url(url))
 
-        # Check if URL exists in visited
-        file_path = self.url_to_filepath.get(url)
+    def get_file_content(self, url):
+        """Retrieve content from file corresponding to the URL."""
+        file_path = self.lookup_file_path(url)
         if file_path and os.path.exists(file_path):
             with open(file_path, "r", encoding="utf-8") as file:
                 return file.read()
@@ -70,26 +118,167 @@ class OllamaStep:
         with open(self.input_json_path, "r", encoding="utf-8") as file:
             return json.load(file)
 
+    def summary_settings(self):
+        """要約の結果を左右する設定（前回と違えば前回の「概要」は引き継がない）"""
+        return {
+            'llm_model': self.llm_model,
+            'llm_prompt_sha256': hashlib.sha256(self.ollama_client.llm_prompt.encode('utf-8')).hexdigest(),
+            'summary_input': self.summary_input,
+        }
+
+    def load_changed_urls(self, since):
+        """前回の実行の開始（since）より後に新規取得・変更されたURLの集合。分からなければNone"""
+        if self.crawl_state:
+            return self.crawl_state.changed_since(since)
+        if self.changed_urls_file and os.path.exists(self.changed_urls_file):
+            with open(self.changed_urls_file, "r", encoding="utf-8") as file:
+                return set(json.load(file))
+        return None
+
+    def load_previous_summaries(self):
+        """
+        Return {URL: summary} from the previous output for pages that did not change since the last run,
+        or None when every entry has to be summarized.
+        """
+        if not os.path.exists(self.output_json_path) or not os.path.exists(self.summary_state_file):
+            return None
+        with open(self.summary_state_file, "r", encoding="utf-8") as file:
+            state = json.load(file)
+        if state.get('settings') != self.summary_settings():
+            logging.info("LLMのモデル・プロンプトが前回の実行と異なるため、全てのページを要約し直します")
+            return None
+        changed = self.load_changed_urls(state['started_at'])
+        if changed is None:
+            return None
+        with open(self.output_json_path, "r", encoding="utf-8") as file:
+            previous = json.load(file)
+        summaries = {}
+        for entry in previous:
+            url = entry.get("URL", {}).get("items")
+            summary = entry.get("概要")
+            if url and isinstance(summary, dict) and summary.get("items") \
+                    and url not in changed and canonicalize_url(url) not in changed:
+                summaries[url] = summary["items"]
+        logging.info(f"Changed pages: {len(changed)}, reusing {len(summaries)} summaries from {self.output_json_path}")
+        return summaries
+
+    def save_summary_state(self, started_at):
+        """
+        実行の記録を保存し、変更されたURLの一覧を空にする（出力を書き終えてから呼ぶ）。
+        開始日時を記録するので、実行中に変わったページは次回に要約し直す。
+        """
+        with open(self.summary_state_file + '.tmp', "w", encoding="utf-8") as file:
+            json.dump({'started_at': started_at, 'settings': self.summary_settings()}, file, ensure_ascii=False, indent=2)
+        os.replace(self.summary_state_file + '.tmp', self.summary_state_file)
+        if self.changed_urls_file and os.path.exists(self.changed_urls_file):
+            with open(self.changed_urls_file + '.tmp', "w", encoding="utf-8") as file:
+                json.dump([], file)
+            os.replace(self.changed_urls_file + '.tmp', self.changed_urls_file)
+
+    def summarize_pages(self, jobs, done):
+        """
+        ページの本文抽出（プロセスプール）とLLMでの要約（スレッドプール）を並行して行い、{index: 要約} を返す。
+        抽出が終わったページから順に要約に回し、処理中のページ数は pipeline_queue_size までに抑える。
+        本文が無いページは結果に含めない。
+        """
+        summaries = {}
+        progress = []
+        lock = threading.Lock()
+        slots = threading.BoundedSemaphore(self.pipeline_queue_size)
+        # 要約のワーカースレッドでもステップの計測値を加算できるように、呼び出し元のcontextvarsを引き継ぐ
+        context = contextvars.copy_context()
+        total_jobs = len(jobs)
+        start = time.perf_counter()
+
+        def finish(job, summary):
+            with lock:
+                if summary is not None:
+                    summaries[job.index] = summary
+                finished = len(progress) + 1
+                progress.append(job.index)
+            slots.release()
+            logging.info(f"Progress: {finished / total_jobs * 100:.2f}% ({finished}/{total_jobs})")
+
+        def on_summarized(job, key, future):
+            summary = []
+            try:
+                summary = future.result()
+                # Failed calls return an empty list; leave them to be retried on resume
+                if summary:
+                    self.checkpoint.append(key, summary)
+            except Exception as e:
+                logging.error(f"要約の保存に失敗しました: {job.url}: {e}")
+            finally:
+                finish(job, summary)
+
+        def on_extracted(job, future):
+            try:
+                content = future.result()
+                # このコールバックは抽出プールのスレッドで呼ばれるので、ステップのcontextvarsの中で加算する
+                context.copy().run(pipeline_metrics.incr, 'pages_extracted')
+                if content is None:
+                    finish(job, None)
+                    return
+                key = checkpoint_key(job.index, f"{job.url}\n{content}")
+                if key in done:
+                    # Resume from the checkpoint without calling the LLM again
+                    finish(job, done[key])
+                    return
+                llm_pool.submit(context.copy().run, self.ollama_client.create_summary, content) \
+                    .add_done_callback(partial(on_summarized, job, key))
+            except Exception as e:
+                logging.error(f"本文の抽出に失敗しました: {job.url}: {e}")
+                finish(job, None)
+
+        # ワーカーが1つならプロセスを起動せず、スレッド1つで抽出する
+        # プロセスはspawnで起動する（LLMのスレッドやスケジューラのスレッドが動いている状態でforkしない）
+        if self.extract_workers > 1:
+            extract_pool = ProcessPoolExecutor(max_workers=self.extract_workers, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            extract_pool = ThreadPoolExecutor(max_workers=1)
+        llm_pool = ThreadPoolExecutor(max_workers=max(1, self.llm_max_in_flight))
+        with extract_pool, llm_pool:
+            for job in jobs:
+                slots.acquire()
+                extract_pool.submit(extract_file_contents, job.file_path, self.summary_input) \
+                    .add_done_callback(partial(on_extracted, job))
+            # 全ページが終わる（全スロットが返される）まで待つ
+            for _ in range(self.pipeline_queue_size):
+                slots.acquire()
+
+        elapsed = time.perf_counter() - start
+        logging.info(f"要約: {total_jobs}ページ, {elapsed:.1f}秒, {total_jobs / max(elapsed, 1e-9):.2f}ページ/秒 "
+                     f"(抽出ワーカー: {self.extract_workers}, LLM同時実行数: {self.llm_max_in_flight}, 先読み: {self.pipeline_queue_size})")
+        return summaries
+
     def get_url_content(self):
         """Replace the '概要' field with a summary from OllamaStep.create_summary()."""
         data = self.load_data()
-        total_entries = len(data)
+        done = self.checkpoint.load()
+        previous_summaries = self.load_previous_summaries() or {}
 
+        jobs = []
         for index, entry in enumerate(data):
             url = entry.get("URL", {}).get("items")
-            if url:
-                html_content = self.get_file_content(url)
-                if html_content:
-                    # Replace the '概要' field with the summary
-                    soup = BeautifulSoup(html_content, 'html.parser')
-                    main_div = soup.find('div', id='contents')
-                    entry["概要"] = self.ollama_client.create_summary(main_div)
-            # 進捗の割合を計算して画面に表示する
-            progress = (index + 1) / total_entries * 100
-            logging.info(f"Progress: {progress:.2f}% ({index + 1}/{total_entries})")
+            if url in previous_summaries:
+                # The page has not changed since the last run
+                entry["概要"] = previous_summaries[url]
+                pipeline_metrics.incr('summaries_reused')
+            elif url:
+                file_path = self.lookup_file_path(url)
+                if file_path and os.path.exists(file_path):
+                    jobs.append(PageJob(index, url, file_path))
+        logging.info(f"要約するページ: {len(jobs)}/{len(data)}件")
+
+        summaries = self.summarize_pages(jobs, done)
+        for index, summary in summaries.items():
+            # Replace the '概要' field with the summary
+            data[index]["概要"] = summary
+        self.checkpoint.close()
         return data
 
     def execute(self):
+        started_at = time.time()
         data = self.get_url_content()
         
         # 変更点：概要フィールドの形式を修正し、itemsとしてリストで保持
@@ -99,24 +288,44 @@ class OllamaStep:
 
         with open(self.output_json_path, "w", encoding="utf-8") as file:
             json.dump(data, file, ensure_ascii=False, indent=2)
+        # The checkpoint is no longer needed once the final output is written
+        self.checkpoint.remove()
+        self.save_summary_state(started_at)
+
+        pipeline_metrics.add_items(len(data))
+        if self.ollama_client.response_cache:
+            self.ollama_client.response_cache.log_stats()
+            pipeline_metrics.incr('llm_cache_hits', self.ollama_client.response_cache.hits)
+            pipeline_metrics.incr('llm_cache_misses', self.ollama_client.response_cache.misses)
+            # 溜まっている参照日時を書き込んで閉じる
+            self.ollama_client.response_cache.close()
 
 
 class OllamaClient:
-    def __init__(self, llm_url, llm_api_key, llm_model, llm_prompt):
+    def __init__(self, llm_url, llm_api_key, llm_model, llm_prompt, timeout=None, max_retries=2, retry_backoff=1.0, requests_per_second=None, response_cache=None):
         self.llm_url = llm_url
         self.llm_api_key = llm_api_key
         self.llm_model = llm_model
         self.llm_prompt = llm_prompt
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.rate_limiter = RateLimiter(float(requests_per_second) if requests_per_second else None)
+        self.response_cache = response_cache
         logging.info(f"LLM prompt : {llm_prompt}")
-        # OpenAIクライアントのセットアップ
+        # OpenAIクライアントのセットアップ（再試行はcall_with_retryで行う）
+        client_options = {'timeout': float(timeout)} if timeout else {}
         self.client = OpenAI(
             base_url=self.llm_url,
             api_key=self.llm_api_key,
+            max_retries=0,
+            **client_options,
         )
 
-    def create_summary(self, content):
-        try:
-            prompt = f"{self.llm_prompt}\n\n{content}"
+    def chat(self, prompt):
+        """レート制限・指数バックオフ付きでチャット補完を呼び出し、応答テキストを返す"""
+        def request():
+            self.rate_limiter.acquire()
+            pipeline_metrics.incr('llm_calls')
             chat_completion = self.client.chat.completions.create(
                 model=self.llm_model,
                 messages=[
@@ -126,10 +335,85 @@ class OllamaClient:
                     }
                 ]
             )
-            response = chat_completion.choices[0].message.content
+            return chat_completion.choices[0].message.content
+        return call_with_retry(request, self.max_retries, self.retry_backoff, description="LLMの呼び出し")
+
+    def create_summary(self, content):
+        try:
+            prompt = f"{self.llm_prompt}\n\n{content}"
+            cache_key = None
+            if self.response_cache:
+                cache_key = self.response_cache.make_key(self.llm_model, 'summary', prompt)
+                response = self.response_cache.get(cache_key)
+                if response is not None:
+                    return response.split('\n')
+
+            start = time.perf_counter()
+            response = self.chat(prompt)
             logging.info("LLMの応答を受信しました")
+            if cache_key:
+                self.response_cache.put(cache_key, self.llm_model, response, time.perf_counter() - start)
             return response.split('\n')
         except Exception as e:
             logging.error(f"LLMの呼び出しに失敗しました: {str(e)}")
             return []
 
+
+def benchmark(pages=40, latency=0.2):
+    """
+    フィクスチャのHTMLをローカルのフェイクLLMサーバで要約し、ページ/秒とプロンプトの大きさを比較する。
+    serial: 従来どおりdivのHTMLを1件ずつ / pipelined: テキストのみを抽出プロセスとLLM同時呼び出しで並行処理
+    """
+    from lib import fake_llm_server
+
+    server, llm_url = fake_llm_server.start_server(latency=latency)
+    modes = (
+        ('serial', {'summary_input': 'html', 'extract_workers': 1, 'llm_max_in_flight': 1}),
+        ('pipelined', {'summary_input': 'text', 'extract_workers': 4, 'llm_max_in_flight': 8}),
+    )
+    with tempfile.TemporaryDirectory() as work_dir:
+        visited = {}
+        catalog = []
+        for n in range(pages):
+            url = f"https://example.com/page/{n}.html"
+            visited[url] = os.path.join(work_dir, f"{n}.html")
+            rows = "".join(f'<tr class="row"><td style="padding:4px">項目{i}</td><td><a href="/p/{i}">手続{i}の説明</a></td></tr>'
+                           for i in range(200))
+            with open(visited[url], "w", encoding="utf-8") as file:
+                file.write(f'<html><head><title>ページ{n}</title><script>var n = {n};</script></head><body>'
+                           f'<div id="header">{"メニュー" * 100}</div><div id="contents"><h1>ページ{n}</h1>'
+                           f'<p class="lead">{"テスト用の本文です。" * 50}</p><table>{rows}</table></div></body></html>')
+            catalog.append({"URL": {"items": url}, "概要": {"items": []}})
+        with open(os.path.join(work_dir, "progress.json"), "w", encoding="utf-8") as file:
+            json.dump({"visited": visited, "to_visit": []}, file)
+        with open(os.path.join(work_dir, "catalog.json"), "w", encoding="utf-8") as file:
+            json.dump(catalog, file, ensure_ascii=False)
+        with open(os.path.join(work_dir, "prompt.txt"), "w", encoding="utf-8") as file:
+            file.write("次の内容を要約してください。")
+
+        for name, options in modes:
+            step = OllamaStep({
+                'progress_file': os.path.join(work_dir, "progress.json"),
+                'input_json_file': os.path.join(work_dir, "catalog.json"),
+                'output_json_file': os.path.join(work_dir, f"{name}.json"),
+                'llm_url': llm_url,
+                'llm_api_key': 'benchmark',
+                'llm_model': 'fake',
+                'llm_prompt_file': os.path.join(work_dir, "prompt.txt"),
+                **options,
+            })
+            prompt_chars = sum(len(extract_file_contents(path, options['summary_input']) or '') for path in visited.values())
+            start = time.perf_counter()
+            step.execute()
+            elapsed = time.perf_counter() - start
+            print(f"{name}: {pages} pages in {elapsed:.1f}s ({pages / elapsed:.1f} pages/s), "
+                  f"{prompt_chars / pages:.0f} chars/prompt on average")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OllamaStepのベンチマーク")
+    parser.add_argument('pages', nargs='?', type=int, default=40, help="要約するフィクスチャのページ数")
+    parser.add_argument('--latency', type=float, default=0.2, help="フェイクLLMサーバの1回あたりの応答遅延（秒）")
+    args = parser.parse_args()
+    benchmark(args.pages, args.latency)
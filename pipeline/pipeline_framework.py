@@ -1,40 +1,135 @@
+import os
 import sys
+import logging
+import argparse
 from step_factory import StepFactory
+from pipeline_scheduler import PipelineScheduler, StepFailedError
+from build_state import BuildState
+from pipeline_metrics import MetricsRecorder
 import yaml
 
 
-# ステップクラスのインポート
-from web_scraper_step import WebScraperStep
-from html2htaglayer_step import Html2HtagLayerStep
-from ollama_step import OllamaStep
-from llm_tag_step import LlmTagStep
-from tfidf_tag_step import TfidfTagStep
-from embedding_step import EmbeddingStep
-from xml_law2json_step import XmlLawToJsonStep
-
 # ステップをファクトリーに登録
-StepFactory.register_step('web_scraper_step', WebScraperStep)
-StepFactory.register_step('html2htaglayer_step', Html2HtagLayerStep)
-StepFactory.register_step('ollama_step', OllamaStep)
-StepFactory.register_step('llm_tag_step', LlmTagStep)
-StepFactory.register_step('tfidf_tag_step', TfidfTagStep)
-StepFactory.register_step('embedding_step', EmbeddingStep)
-StepFactory.register_step('xml_law2json_step', XmlLawToJsonStep)
-
-def execute_pipeline(pipeline_config_path):
+# クラスは 'module:ClassName' で指定し、YAMLで使われたステップのモジュールだけを実行時にimportする
+# （torch・MeCab・openai などの重い依存を、使わないステップのために読み込まない）
+# inputs / outputs はステップ間の依存関係を求めるためのファイルパスのキー
+# shared は複数のステップが読み書きするキャッシュのキー（同じキャッシュを使うステップは同時に実行しない）
+StepFactory.register_step('web_scraper_step', 'web_scraper_step:WebScraperStep',
+                          outputs=['output_dir', 'progress_file', 'crawl_state_db', 'changed_urls_file'])
+StepFactory.register_step('ollama_step', 'ollama_step:OllamaStep',
+                          inputs=['progress_file', 'crawl_state_db', 'changed_urls_file', 'input_json_file', 'llm_prompt_file'],
+                          outputs=['output_json_file', 'summary_state_file'], shared=['llm_cache_file'])
+StepFactory.register_step('llm_tag_step', 'llm_tag_step:LlmTagStep',
+                          inputs=['input_json_file', 'llm_prompt_file'], outputs=['output_json_file'], shared=['llm_cache_file'])
+StepFactory.register_step('tfidf_tag_step', 'tfidf_tag_step:TfidfTagStep',
+                          inputs=['input_json_file'], outputs=['output_json_file'], shared=['tokenize_cache_file'])
+StepFactory.register_step('embedding_step', 'embedding_step:EmbeddingStep',
+                          inputs=['law_catalog_json'], outputs=['embeddings_file'], shared=['embedding_cache_file'])
+StepFactory.register_step('xml_law2json_step', 'xml_law2json_step:XmlLawToJsonStep',
+                          inputs=['xml_input_dir'], outputs=['json_output_file'])
+StepFactory.register_step('similarity_search_step', 'similarity_search_step:SimilaritySearchStep',
+                          inputs=['embeddings_file'], outputs=['output_json_file'])
+
+
+def run_step(planned_step):
+    step = StepFactory.create_step(planned_step.type, planned_step.config)
+    step.execute()
+
+
+def make_step_runner(recorder, build_state=None, force=()):
+    """ステップごとに計測しながら実行するrun_step。ビルド状態があれば、最新のステップは実行を省略する"""
+    def run(planned_step):
+        with recorder.step(planned_step.name, planned_step.type) as metrics:
+            if build_state is not None:
+                code_version = StepFactory.code_version(planned_step.type)
+                if planned_step.name in force or 'all' in force:
+                    logging.info(f"強制実行: {planned_step.name}")
+                else:
+                    reason = build_state.outdated_reason(planned_step, code_version)
+                    if reason is None:
+                        print(f"Skipping step (up to date): {planned_step.name}")
+                        metrics.status = 'up_to_date'
+                        return
+                    logging.info(f"実行: {planned_step.name} ({reason})")
+            run_step(planned_step)
+            if build_state is not None:
+                build_state.record(planned_step, code_version)
+    return run
+
+
+def default_state_file(pipeline_config_path):
+    return f"{os.path.splitext(pipeline_config_path)[0]}.state.json"
+
+
+def default_metrics_file(pipeline_config_path):
+    return f"{os.path.splitext(pipeline_config_path)[0]}.metrics.json"
+
+
+def execute_pipeline(pipeline_config_path, max_workers=None, dry_run=False, force=(), use_build_state=True,
+                     profile=(), profiler='cprofile', metrics_file=None):
     with open(pipeline_config_path, 'r') as file:
         pipeline_config = yaml.safe_load(file)
 
-    for step_config in pipeline_config.get('steps', []):
-        # skip_flgがtrueとして評価されるかどうかをチェック
-        if step_config.get('skip_flg', False) == True:
-            print(f"Skipping step: {step_config['name']}")
-            continue
+    # 並列数: 引数 > pipeline.yaml の max_workers > 1（従来通り1つずつ）
+    if max_workers is None:
+        max_workers = pipeline_config.get('max_workers', 1)
+    scheduler = PipelineScheduler(pipeline_config.get('steps', []), StepFactory.io_keys, max_workers)
 
-        step = StepFactory.create_step(step_config['type'], step_config)
-        step.execute()
+    step_names = {step.name for step in scheduler.steps} | {'all'}
+    for option, names in (('--force', force), ('--profile', profile)):
+        unknown = set(names) - step_names
+        if unknown:
+            raise ValueError(f"{option} に指定されたステップがありません（スキップ指定のステップも対象外）: {', '.join(sorted(unknown))}")
+    force = set(force)
 
-if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        execute_pipeline(sys.argv[1])
+    build_state = None
+    if use_build_state:
+        # 前回実行時のステップごとの入力・出力・設定のハッシュ（これと同じなら実行を省略する）
+        build_state = BuildState(pipeline_config.get('build_state_file') or default_state_file(pipeline_config_path))
+
+    if dry_run:
+        print(scheduler.describe())
+        if build_state:
+            for step in scheduler.steps:
+                reason = "強制実行" if step.name in force or 'all' in force else \
+                    build_state.outdated_reason(step, StepFactory.code_version(step.type))
+                print(f"  {step.name}: {reason or '最新（実行を省略）'}")
+        return
+
+    # ステップごとの実行時間・メモリ・処理件数などの実行レポート
+    metrics_file = metrics_file or pipeline_config.get('metrics_file') or default_metrics_file(pipeline_config_path)
+    recorder = MetricsRecorder(profile, profiler, profile_dir=f"{os.path.splitext(metrics_file)[0]}_profiles")
+    try:
+        scheduler.run(make_step_runner(recorder, build_state, force))
+    finally:
+        if recorder.steps:
+            print(recorder.summary_table())
+            recorder.write_report(metrics_file)
 
+
+def main():
+    parser = argparse.ArgumentParser(description="pipeline.yaml のステップを依存関係の順に実行する")
+    parser.add_argument("pipeline_config", help="パイプライン設定のYAMLファイル")
+    parser.add_argument("--workers", type=int, default=None, help="同時に実行するステップ数の上限")
+    parser.add_argument("--dry-run", action="store_true", help="実行計画を表示するだけで実行しない")
+    parser.add_argument("--force", action="append", default=[], metavar="STEP",
+                        help="入力が変わっていなくても実行するステップ名（複数指定可、all で全ステップ）")
+    parser.add_argument("--no-build-state", action="store_true",
+                        help="更新判定を行わず、スキップ指定以外の全ステップを実行する")
+    parser.add_argument("--profile", action="append", default=[], metavar="STEP",
+                        help="プロファイルするステップ名（複数指定可、all で全ステップ）")
+    parser.add_argument("--profiler", choices=['cprofile', 'pyinstrument'], default='cprofile',
+                        help="--profile で使うプロファイラ（pyinstrument は別途インストールが必要）")
+    parser.add_argument("--metrics-file", default=None, help="実行レポート（JSON）の出力先")
+    args = parser.parse_args()
+    try:
+        execute_pipeline(args.pipeline_config, max_workers=args.workers, dry_run=args.dry_run,
+                         force=args.force, use_build_state=not args.no_build_state,
+                         profile=args.profile, profiler=args.profiler, metrics_file=args.metrics_file)
+    except StepFailedError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
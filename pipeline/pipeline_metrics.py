@@ -0,0 +1,210 @@
+import os
+import io
+import json
+import time
+import pstats
+import logging
+import resource
+import threading
+import contextvars
+from contextlib import contextmanager
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 実行中のステップの計測値（ステップのスレッドと、そこから run_ordered などで起動したスレッドで参照する）
+_current_step = contextvars.ContextVar('pipeline_step_metrics', default=None)
+
+
+def incr(name, value=1):
+    """
+    実行中のステップのカウンター（LLM呼び出し回数、キャッシュヒット数、取得ページ数など）を加算する。
+    パイプラインの外（ステップを単体で実行した場合など）では何もしない。
+    """
+    metrics = _current_step.get()
+    if metrics is not None:
+        metrics.incr(name, value)
+
+
+def add_items(count=1):
+    """実行中のステップで処理した件数（items/sec の計算に使う）を加算する"""
+    metrics = _current_step.get()
+    if metrics is not None:
+        metrics.add_items(count)
+
+
+def rusage_snapshot():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'cpu': own.ru_utime + own.ru_stime,
+        'children_cpu': children.ru_utime + children.ru_stime,
+        # Linuxでは ru_maxrss の単位はKB
+        'max_rss_mb': own.ru_maxrss / 1024,
+        'children_max_rss_mb': children.ru_maxrss / 1024,
+    }
+
+
+class StepMetrics:
+    def __init__(self, name, step_type):
+        self.name = name
+        self.type = step_type
+        self.status = 'running'
+        self.error = None
+        self.items = 0
+        self.counters = {}
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.children_cpu_seconds = 0.0
+        self.peak_rss_mb = 0.0
+        self.children_peak_rss_mb = 0.0
+        self.profile_file = None
+        self.lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_items(self, count=1):
+        with self.lock:
+            self.items += count
+
+    @property
+    def items_per_second(self):
+        return self.items / self.wall_seconds if self.wall_seconds > 0 else 0.0
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'type': self.type,
+            'status': self.status,
+            'error': self.error,
+            'wall_seconds': round(self.wall_seconds, 3),
+            'cpu_seconds': round(self.cpu_seconds, 3),
+            'children_cpu_seconds': round(self.children_cpu_seconds, 3),
+            'peak_rss_mb': round(self.peak_rss_mb, 1),
+            'children_peak_rss_mb': round(self.children_peak_rss_mb, 1),
+            'items': self.items,
+            'items_per_second': round(self.items_per_second, 2),
+            'counters': dict(sorted(self.counters.items())),
+            'profile_file': self.profile_file,
+        }
+
+
+class MetricsRecorder:
+    """
+    ステップごとの 実行時間・CPU時間・ピークRSS・処理件数・カスタムカウンター を記録し、
+    JSONのレポートと要約の表を出力する。
+    CPU時間とRSSはプロセス全体（子プロセスは別集計）の値なので、ステップを並列に実行した場合は
+    同時に動いていたステップの分も含む。ピークRSSはそのステップの終了時点までのプロセスの最大値。
+    profile にステップ名（all で全ステップ）を指定すると、そのステップをプロファイルする（cProfile / pyinstrument）。
+    """
+
+    def __init__(self, profile=(), profiler='cprofile', profile_dir='.'):
+        self.steps = []
+        self.profile = set(profile)
+        self.profiler = profiler
+        self.profile_dir = profile_dir
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        # プロファイラは同時に1つしか有効にできないため、並列実行時は1ステップずつ計測する
+        self.profile_lock = threading.Lock()
+
+    def should_profile(self, name):
+        return name in self.profile or 'all' in self.profile
+
+    @contextmanager
+    def step(self, name, step_type):
+        metrics = StepMetrics(name, step_type)
+        with self.lock:
+            self.steps.append(metrics)
+        token = _current_step.set(metrics)
+        before = rusage_snapshot()
+        start = time.perf_counter()
+        try:
+            with self.profiling(metrics):
+                yield metrics
+            if metrics.status == 'running':
+                metrics.status = 'ok'
+        except Exception as e:
+            metrics.status = 'failed'
+            metrics.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            after = rusage_snapshot()
+            metrics.wall_seconds = time.perf_counter() - start
+            metrics.cpu_seconds = after['cpu'] - before['cpu']
+            metrics.children_cpu_seconds = after['children_cpu'] - before['children_cpu']
+            metrics.peak_rss_mb = after['max_rss_mb']
+            metrics.children_peak_rss_mb = after['children_max_rss_mb']
+            _current_step.reset(token)
+
+    @contextmanager
+    def profiling(self, metrics):
+        if not self.should_profile(metrics.name):
+            yield
+            return
+        if not self.profile_lock.acquire(blocking=False):
+            logging.warning(f"他のステップをプロファイル中のため、プロファイルしません: {metrics.name}")
+            yield
+            return
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            base = os.path.join(self.profile_dir, "".join(ch if ch.isalnum() or ch in '-_' else '_' for ch in metrics.name))
+            if self.profiler == 'pyinstrument':
+                from pyinstrument import Profiler
+                profiler = Profiler()
+                profiler.start()
+                try:
+                    yield
+                finally:
+                    profiler.stop()
+                    metrics.profile_file = f"{base}.html"
+                    with open(metrics.profile_file, 'w', encoding='utf-8') as f:
+                        f.write(profiler.output_html())
+            else:
+                import cProfile
+                profiler = cProfile.Profile()
+                profiler.enable()
+                try:
+                    yield
+                finally:
+                    profiler.disable()
+                    metrics.profile_file = f"{base}.prof"
+                    profiler.dump_stats(metrics.profile_file)
+                    stream = io.StringIO()
+                    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(20)
+                    logging.info(f"プロファイル（{metrics.name}、累積時間の上位20件）:\n{stream.getvalue()}")
+            logging.info(f"プロファイルを出力しました: {metrics.profile_file}")
+        finally:
+            self.profile_lock.release()
+
+    def report(self):
+        return {
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started_at)),
+            'wall_seconds': round(time.perf_counter() - self.start, 3),
+            'steps': [metrics.to_dict() for metrics in self.steps],
+        }
+
+    def write_report(self, report_file):
+        report_dir = os.path.dirname(report_file)
+        if report_dir:
+            os.makedirs(report_dir, exist_ok=True)
+        with open(report_file, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2)
+        logging.info(f"実行レポートを出力しました: {report_file}")
+
+    def summary_table(self):
+        header = ['step', 'status', 'wall s', 'cpu s', 'child cpu s', 'peak RSS MB', 'items', 'items/s', 'counters']
+        rows = []
+        for metrics in self.steps:
+            counters = ", ".join(f"{key}={value}" for key, value in sorted(metrics.counters.items()))
+            rows.append([
+                metrics.name, metrics.status,
+                f"{metrics.wall_seconds:.2f}", f"{metrics.cpu_seconds:.2f}", f"{metrics.children_cpu_seconds:.2f}",
+                f"{metrics.peak_rss_mb:.0f}", str(metrics.items), f"{metrics.items_per_second:.1f}", counters,
+            ])
+        widths = [max(len(str(row[i])) for row in [header] + rows) for i in range(len(header))]
+        lines = ["  ".join(str(cell).ljust(width) for cell, width in zip(row, widths)).rstrip() for row in [header] + rows]
+        lines.insert(1, "  ".join("-" * width for width in widths))
+        return "\n".join(lines)
@@ -0,0 +1,193 @@
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class StepFailedError(RuntimeError):
+    """ステップの実行に失敗した（どのステップで失敗したかを保持する）"""
+
+    def __init__(self, failures, not_run):
+        self.failures = failures
+        self.not_run = not_run
+        lines = [f"ステップ '{step.name}' ({step.type}) が失敗しました: {type(error).__name__}: {error}" for step, error in failures]
+        if not_run:
+            lines.append(f"実行されなかったステップ: {', '.join(step.name for step in not_run)}")
+        super().__init__("\n".join(lines))
+
+
+def normalize_path(path):
+    return os.path.normpath(os.path.abspath(path))
+
+
+def paths_overlap(a, b):
+    """同じパスか、一方が他方のディレクトリ配下にある"""
+    try:
+        return os.path.commonpath([a, b]) in (a, b)
+    except ValueError:
+        return False
+
+
+class PlannedStep:
+    def __init__(self, index, name, step_config, inputs, outputs, shared=()):
+        self.index = index
+        self.name = name
+        self.type = step_config['type']
+        self.config = step_config
+        self.inputs = inputs
+        self.outputs = outputs
+        # 他のステップと共有して読み書きするファイル（キャッシュなど）
+        self.shared = list(shared)
+        self.depends = set()
+        self.level = 0
+
+    def reads_from(self, other):
+        return any(paths_overlap(i, o) for i in self.inputs for o in other.outputs)
+
+    def conflicts_with(self, other):
+        """同じファイルへの書き込み、相手が読むファイルへの書き込み、または同じ共有ファイル（キャッシュ）の読み書き"""
+        return (any(paths_overlap(a, b) for a in self.outputs for b in other.outputs)
+                or any(paths_overlap(o, i) for o in self.outputs for i in other.inputs)
+                or any(paths_overlap(a, b) for a in self.shared for b in other.shared))
+
+
+class PipelineScheduler:
+    """
+    pipeline.yaml のステップを依存関係のDAGとして実行する。
+    依存関係は、ステップ種別ごとに登録された入出力のキー（StepFactory.register_step の inputs / outputs）の
+    ファイルパスと、ステップ設定の depends_on（ステップ名のリスト）から求める。
+    YAMLで前にあるステップの出力を読む・同じファイルに書く・同じキャッシュを使うステップは、そのステップの完了を待つ。
+    依存関係の無いステップは max_workers 個まで並列に実行し、どれかが失敗したら新しいステップは開始しない。
+    """
+
+    def __init__(self, step_configs, io_keys, max_workers=1):
+        self.max_workers = max(1, int(max_workers))
+        self.skipped = []
+        self.steps = self.build_plan(step_configs, io_keys)
+
+    @staticmethod
+    def step_name(step_config, index, names):
+        name = step_config.get('name') or step_config['type']
+        # 同じ名前のステップが複数ある場合は番号を付けて区別する
+        return name if names.count(name) == 1 else f"{name}#{index + 1}"
+
+    def build_plan(self, step_configs, io_keys):
+        names = [config.get('name') or config['type'] for config in step_configs]
+        steps = []
+        skipped_names = set()
+        for index, step_config in enumerate(step_configs):
+            name = self.step_name(step_config, index, names)
+            # skip_flgがtrueとして評価されるかどうかをチェック
+            if step_config.get('skip_flg', False) == True:
+                self.skipped.append(name)
+                skipped_names.add(name)
+                skipped_names.add(names[index])
+                continue
+            input_keys, output_keys, shared_keys = io_keys(step_config['type'])
+            inputs = [normalize_path(step_config[key]) for key in input_keys if step_config.get(key)]
+            outputs = [normalize_path(step_config[key]) for key in output_keys if step_config.get(key)]
+            shared = [normalize_path(step_config[key]) for key in shared_keys if step_config.get(key)]
+            steps.append(PlannedStep(index, name, step_config, inputs, outputs, shared))
+
+        by_name = {}
+        for step in steps:
+            by_name[step.name] = step
+            by_name.setdefault(names[step.index], step)
+
+        for position, step in enumerate(steps):
+            for earlier in steps[:position]:
+                if step.reads_from(earlier) or step.conflicts_with(earlier):
+                    step.depends.add(earlier.name)
+            depends_on = step.config.get('depends_on') or []
+            if isinstance(depends_on, str):
+                depends_on = [name.strip() for name in depends_on.split(',') if name.strip()]
+            for dependency in depends_on:
+                if dependency in by_name:
+                    step.depends.add(by_name[dependency].name)
+                elif dependency in skipped_names:
+                    logging.info(f"'{step.name}' の依存先 '{dependency}' はスキップされるため、完了を待ちません")
+                else:
+                    raise ValueError(f"ステップ '{step.name}' の depends_on に不明なステップがあります: {dependency}")
+            step.depends.discard(step.name)
+
+        self.assign_levels(steps)
+        return steps
+
+    @staticmethod
+    def assign_levels(steps):
+        """依存の深さ（並列に実行できるグループ）を求める。循環していればエラー"""
+        by_name = {step.name: step for step in steps}
+        resolved = {}
+        visiting = set()
+
+        def level(step):
+            if step.name in resolved:
+                return resolved[step.name]
+            if step.name in visiting:
+                raise ValueError(f"ステップの依存関係が循環しています: {step.name}")
+            visiting.add(step.name)
+            step.level = 1 + max((level(by_name[name]) for name in step.depends), default=-1)
+            visiting.discard(step.name)
+            resolved[step.name] = step.level
+            return step.level
+
+        for step in steps:
+            level(step)
+
+    def describe(self):
+        """実行計画（並列に実行できるグループごとのステップ）の文字列"""
+        lines = [f"実行計画: {len(self.steps)}ステップ (並列数: {self.max_workers})"]
+        for level in sorted({step.level for step in self.steps}):
+            lines.append(f"  グループ {level + 1}:")
+            for step in self.steps:
+                if step.level != level:
+                    continue
+                depends = f" ← {', '.join(sorted(step.depends))}" if step.depends else ""
+                lines.append(f"    - {step.name} ({step.type}){depends}")
+        for name in self.skipped:
+            lines.append(f"  スキップ: {name}")
+        return "\n".join(lines)
+
+    def run(self, run_step):
+        """run_step(planned_step) を依存関係の順に実行する。失敗したら StepFailedError"""
+        for name in self.skipped:
+            print(f"Skipping step: {name}")
+
+        pending = list(self.steps)
+        done = set()
+        failures = []
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='step') as executor:
+            while pending or running:
+                if not failures:
+                    # YAMLの順に、依存先が全て完了したステップから開始する
+                    for step in [step for step in pending if step.depends <= done]:
+                        if len(running) >= self.max_workers:
+                            break
+                        pending.remove(step)
+                        logging.info(f"ステップ開始: {step.name}")
+                        running[executor.submit(self.timed, run_step, step)] = step
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        logging.error(f"ステップ失敗: {step.name}: {type(error).__name__}: {error}", exc_info=error)
+                        failures.append((step, error))
+                    else:
+                        done.add(step.name)
+                if failures and running:
+                    logging.error(f"実行中のステップの終了を待ちます: {', '.join(s.name for s in running.values())}")
+
+        if failures:
+            raise StepFailedError(failures, pending) from failures[0][1]
+
+    @staticmethod
+    def timed(run_step, step):
+        start = time.perf_counter()
+        run_step(step)
+        logging.info(f"ステップ完了: {step.name} ({time.perf_counter() - start:.1f}秒)")
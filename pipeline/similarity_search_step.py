@@ -0,0 +1,148 @@
+import sys
+import json
+import time
+import argparse
+import logging
+import numpy as np
+from lib.embedding_store import load_embeddings
+from lib.similarity_index import SimilarityIndex, IvfIndex
+import pipeline_metrics
+
+# ロギングの設定
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+class SimilaritySearchStep:
+    """保存済みの法令ベクトルから、テキストまたはLawNumに類似する法令を検索する"""
+
+    def __init__(self, step_config):
+        self.embeddings_file = step_config['embeddings_file']
+        self.output_json_path = step_config.get('output_json_file', '')
+        self.query_texts = as_list(step_config.get('query_text'))
+        self.query_law_nums = as_list(step_config.get('query_law_num'))
+        self.top_k = int(step_config.get('top_k', 10))
+        # exact: 全件検索 / ivf: 近似検索（大規模コーパス向け）
+        self.index_type = step_config.get('index_type', 'exact')
+        self.ivf_lists = step_config.get('ivf_lists')
+        self.ivf_probe = int(step_config.get('ivf_probe', 8))
+        self.model_name = step_config.get('model_name', 'bert-base-uncased')
+        self.embedder = None
+
+    def build_index(self, embeddings):
+        start = time.perf_counter()
+        if self.index_type == 'ivf':
+            index = IvfIndex(embeddings, n_lists=self.ivf_lists, n_probe=self.ivf_probe)
+        else:
+            index = SimilarityIndex(embeddings)
+        logging.info(f"インデックス作成完了 ({self.index_type}): {len(index)}件, {time.perf_counter() - start:.2f}秒")
+        return index
+
+    def embed_texts(self, texts):
+        """クエリテキストをEmbeddingStepと同じモデルでベクトル化する"""
+        if self.embedder is None:
+            # torch / transformers はテキスト検索の時だけ読み込む
+            from embedding_step import BertEmbedder
+            self.embedder = BertEmbedder(self.model_name)
+        return self.embedder.embed_batch(texts)
+
+    def search(self, index, entries, queries, vectors, exclude_rows=None):
+        start = time.perf_counter()
+        # 自分自身を除外する分だけ1件多く取る
+        k = self.top_k + (1 if exclude_rows else 0)
+        indices, scores = index.search_batch(vectors, k)
+        elapsed = time.perf_counter() - start
+        logging.info(f"検索完了: {len(queries)}クエリ, {elapsed * 1000:.1f}ms ({elapsed * 1000 / max(len(queries), 1):.2f}ms/クエリ)")
+
+        results = []
+        for i, query in enumerate(queries):
+            hits = []
+            for row, score in zip(indices[i], scores[i]):
+                if row < 0 or (exclude_rows and row == exclude_rows[i]):
+                    continue
+                hits.append(dict(entries[row], score=float(score)))
+            results.append({'query': query, 'results': hits[:self.top_k]})
+        return results
+
+    def execute(self):
+        embeddings, entries = load_embeddings(self.embeddings_file)
+        index = self.build_index(embeddings)
+        results = []
+
+        if self.query_texts:
+            results += self.search(index, entries, self.query_texts, self.embed_texts(self.query_texts))
+
+        if self.query_law_nums:
+            law_num_to_row = {entry.get('law_num'): row for row, entry in enumerate(entries)}
+            rows = []
+            for law_num in self.query_law_nums:
+                if law_num in law_num_to_row:
+                    rows.append(law_num_to_row[law_num])
+                else:
+                    logging.error(f"LawNumが見つかりません: {law_num}")
+            if rows:
+                queries = [entries[row].get('law_num') for row in rows]
+                results += self.search(index, entries, queries, np.asarray(embeddings[rows]), exclude_rows=rows)
+
+        pipeline_metrics.add_items(len(results))
+        if self.output_json_path:
+            with open(self.output_json_path, 'w', encoding='utf-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+            logging.info(f"検索結果を出力しました: {self.output_json_path}")
+        else:
+            for result in results:
+                print(f"# {result['query']}")
+                for hit in result['results']:
+                    print(f"  {hit['score']:.4f}  {hit.get('law_num')}  {hit.get('law_text')}")
+        return results
+
+
+def benchmark(sizes=(10000, 100000), dim=768, n_queries=100, k=10):
+    """ランダムベクトルで検索レイテンシを計測する"""
+    rng = np.random.default_rng(0)
+    for n in sizes:
+        embeddings = rng.standard_normal((n, dim), dtype=np.float32)
+        queries = rng.standard_normal((n_queries, dim), dtype=np.float32)
+        for name, build in (('exact', SimilarityIndex), ('ivf', IvfIndex)):
+            start = time.perf_counter()
+            index = build(embeddings)
+            build_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for query in queries[:10]:
+                index.search(query, k)
+            single = (time.perf_counter() - start) / 10
+
+            start = time.perf_counter()
+            index.search_batch(queries, k)
+            batch = (time.perf_counter() - start) / n_queries
+            print(f"{name:5s} n={n:>7d}: build {build_time:.2f}s, single {single * 1000:.2f}ms/query, batch {batch * 1000:.2f}ms/query")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="法令ベクトルの類似検索")
+    parser.add_argument('embeddings_file', nargs='?')
+    parser.add_argument('--text', action='append', help="検索するテキスト")
+    parser.add_argument('--law-num', action='append', help="類似法令を探すLawNum")
+    parser.add_argument('-k', '--top-k', type=int, default=10)
+    parser.add_argument('--index', choices=['exact', 'ivf'], default='exact')
+    parser.add_argument('--benchmark', action='store_true', help="10k/100k件のランダムベクトルでレイテンシを計測")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark()
+        sys.exit(0)
+    if not args.embeddings_file:
+        parser.error("embeddings_file を指定してください")
+    SimilaritySearchStep({
+        'embeddings_file': args.embeddings_file,
+        'query_text': args.text,
+        'query_law_num': args.law_num,
+        'top_k': args.top_k,
+        'index_type': args.index,
+    }).execute()
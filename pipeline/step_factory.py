@@ -1,15 +1,116 @@
+import os
+import ast
+import hashlib
+import inspect
+import importlib
+import importlib.util
+
+
+# ステップのモジュールと、コードのハッシュに含める pipeline/ 内のモジュール（lib/ など）の置き場所
+PIPELINE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
 class StepFactory:
     _steps = {}
+    _io_keys = {}
 
     @classmethod
-    def register_step(cls, step_type, step_class):
+    def register_step(cls, step_type, step_class, inputs=(), outputs=(), shared=()):
+        # step_class: クラス、または 'module:ClassName' 形式の文字列（最初に使われる時にimportする）
+        # inputs / outputs: 入力・出力のファイル（ディレクトリ）パスを持つステップ設定のキー
+        # shared: 読み書きするキャッシュなど、複数のステップで共有するファイルのキー（同時には実行しないが、ビルド状態の判定には使わない）
         cls._steps[step_type] = step_class
+        cls._io_keys[step_type] = (tuple(inputs), tuple(outputs), tuple(shared))
 
     @classmethod
-    def create_step(cls, step_type, *args, **kwargs):
+    def io_keys(cls, step_type):
+        if step_type not in cls._steps:
+            raise ValueError(f"Step type {step_type} not registered")
+        return cls._io_keys[step_type]
+
+    @staticmethod
+    def split_reference(reference):
+        module_name, _, class_name = reference.partition(':')
+        if not class_name:
+            module_name, _, class_name = reference.rpartition('.')
+        return module_name, class_name
+
+    @classmethod
+    def get_step_class(cls, step_type):
+        step_class = cls._steps.get(step_type)
+        if step_class is None:
+            raise ValueError(f"Step type {step_type} not registered")
+        if isinstance(step_class, str):
+            module_name, class_name = cls.split_reference(step_class)
+            step_class = getattr(importlib.import_module(module_name), class_name)
+            cls._steps[step_type] = step_class
+        return step_class
+
+    @classmethod
+    def source_file(cls, step_type):
+        """ステップのモジュールのファイル（未importのモジュールはimportせずに探す）"""
         step_class = cls._steps.get(step_type)
-        if step_class is not None:
-            return step_class(*args, **kwargs)
-        else:
+        if step_class is None:
             raise ValueError(f"Step type {step_type} not registered")
+        if not isinstance(step_class, str):
+            return inspect.getsourcefile(step_class)
+        module_name, _ = cls.split_reference(step_class)
+        spec = importlib.util.find_spec(module_name)
+        if spec is None or not spec.origin:
+            raise ValueError(f"Module {module_name} for step type {step_type} not found")
+        return spec.origin
+
+    @staticmethod
+    def local_module_file(module_name):
+        """pipeline/ 内のモジュールならそのファイル、それ以外（標準ライブラリ・外部パッケージ）はNone"""
+        base = os.path.join(PIPELINE_DIR, *module_name.split('.'))
+        for path in (base + '.py', os.path.join(base, '__init__.py')):
+            if os.path.isfile(path):
+                return path
+        return None
+
+    @classmethod
+    def local_dependencies(cls, source_file):
+        """
+        source_file と、そこから（間接的にも）importしている pipeline/ 内のモジュールのファイル。
+        importはせずにソースのimport文から求める（使わないステップの重い依存を読み込まないため）。
+        """
+        files = set()
+        pending = [os.path.abspath(source_file)]
+        while pending:
+            path = pending.pop()
+            if path in files:
+                continue
+            files.add(path)
+            with open(path, 'rb') as f:
+                tree = ast.parse(f.read(), path)
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Import):
+                    names = [alias.name for alias in node.names]
+                elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                    # from lib import page_parser のようにモジュールをimportする場合もある
+                    names = [node.module] + [f"{node.module}.{alias.name}" for alias in node.names]
+                else:
+                    continue
+                for name in names:
+                    module_file = cls.local_module_file(name)
+                    if module_file:
+                        pending.append(module_file)
+        return sorted(files)
+
+    @classmethod
+    def code_version(cls, step_type):
+        """
+        ステップのモジュールと、それがimportしている pipeline/ 内のモジュール（lib/ や pipeline_metrics など）のソースのハッシュ。
+        どれかのコードが変わったら再実行するため。
+        """
+        digest = hashlib.sha256()
+        for path in cls.local_dependencies(cls.source_file(step_type)):
+            digest.update(os.path.relpath(path, PIPELINE_DIR).encode('utf-8') + b'\0')
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        return digest.hexdigest()
 
+    @classmethod
+    def create_step(cls, step_type, *args, **kwargs):
+        return cls.get_step_class(step_type)(*args, **kwargs)
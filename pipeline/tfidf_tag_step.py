@@ -1,8 +1,35 @@
+import sys
 import json
+import time
 import MeCab
+import logging
+import multiprocessing
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from sklearn.feature_extraction.text import TfidfVectorizer
+from lib.tokenization_cache import TokenizationCache
+from lib.law_text import load_law_texts
+import pipeline_metrics
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+MECAB_ARGS = "-Owakati"
+
+# プロセスプールの各ワーカーが保持するTagger
+_worker_mecab = None
+
+
+def _init_tokenizer_worker():
+    global _worker_mecab
+    _worker_mecab = MeCab.Tagger(MECAB_ARGS)
+
+
+def _tokenize_chunk(texts):
+    return [" ".join(_worker_mecab.parse(text).strip().split()) for text in texts]
+
 
 class TfidfTagStep:
     def __init__(self, step_config):
@@ -10,66 +37,164 @@ class TfidfTagStep:
         self.output_json_path = step_config['output_json_file']
         self.exclude_words = set(step_config.get('exclude_words', "").split(',')) if isinstance(step_config.get('exclude_words'), str) else set(step_config.get('exclude_words', []))
         self.exclude_words = {word.strip() for word in self.exclude_words}  # 空白を削除
-        self.mecab = MeCab.Tagger("-Owakati")
-
-    def extract_text(self, law):
-        """Lawオブジェクトから特定のフィールドのテキストを抽出"""
-        texts = []
-        fields = ['@Abbrev', '#text', 'EnactStatement', 'ChapterTitle', 'ArticleCaption', 'ArticleTitle', 'Sentence']
-        
-        for key, value in law.items():
-            if key in fields and isinstance(value, str):
-                texts.append(value)
-            elif isinstance(value, dict):
-                texts.extend(self.extract_text(value))
-            elif isinstance(value, list):
-                for item in value:
-                    if isinstance(item, dict):
-                        texts.extend(self.extract_text(item))
-        return texts
+        # per_law: 法令ごとに文単位でTF-IDF / corpus: 全法令で1つのTF-IDFを学習（IDFがコーパス全体を反映する）
+        self.tfidf_mode = step_config.get('tfidf_mode', 'per_law')
+        self.max_tags = int(step_config.get('max_tags', 5))
+        # 法令ごとの抽出テキストの中間ファイル（JSONL）。未指定なら毎回法令JSONから抽出する
+        self.law_text_file = step_config.get('law_text_file')
+        self.mecab = MeCab.Tagger(MECAB_ARGS)
+        # 形態素解析の並列数と、1回でワーカーに渡す文の数（大きいほどプロセス間通信が減る）
+        self.tokenize_workers = int(step_config.get('tokenize_workers', 1))
+        self.tokenize_chunksize = int(step_config.get('tokenize_chunksize', 2000))
+        cache_file = step_config.get('tokenize_cache_file')
+        self.token_cache = TokenizationCache(cache_file, namespace=f"mecab {MECAB_ARGS}") if cache_file else None
 
     def tokenize_and_clean(self, text):
         """形態素解析を用いてテキストをトークナイズ"""
         words = self.mecab.parse(text).strip().split()
         return " ".join(words)
 
-    def execute(self):
-        """TF-IDFを使用してLawごとに最大5つの特徴的なタグを抽出し、結果をJSONに保存"""
-        with open(self.input_json_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        
-        for law in data:
-            all_texts = self.extract_text(law)
-            all_texts = [text.strip() for text in all_texts if text.strip()]
-            
-            processed_texts = [self.tokenize_and_clean(text) for text in all_texts]
-            
+    def tokenize_texts(self, texts):
+        """
+        文のリストをまとめて分かち書きする。
+        重複する文は1回だけ解析し、キャッシュに無い文だけをプロセスプールで並列に解析する。
+        """
+        unique_texts = list(dict.fromkeys(texts))
+        tokenized = self.token_cache.get_many(unique_texts) if self.token_cache else {}
+        missing = [text for text in unique_texts if text not in tokenized]
+
+        start = time.perf_counter()
+        if self.tokenize_workers > 1 and len(missing) > self.tokenize_chunksize:
+            chunks = [missing[i:i + self.tokenize_chunksize] for i in range(0, len(missing), self.tokenize_chunksize)]
+            new_tokens = {}
+            # スケジューラのスレッドからforkしないよう、ワーカーはspawnで起動する
+            with ProcessPoolExecutor(max_workers=self.tokenize_workers, initializer=_init_tokenizer_worker,
+                                     mp_context=multiprocessing.get_context('spawn')) as executor:
+                for chunk, tokens in zip(chunks, executor.map(_tokenize_chunk, chunks)):
+                    new_tokens.update(zip(chunk, tokens))
+        else:
+            new_tokens = {text: self.tokenize_and_clean(text) for text in missing}
+        elapsed = time.perf_counter() - start
+
+        if self.token_cache and new_tokens:
+            self.token_cache.put_many(new_tokens)
+        pipeline_metrics.incr('sentences_tokenized', len(missing))
+        pipeline_metrics.incr('tokenize_cache_hits', len(unique_texts) - len(missing))
+        tokenized.update(new_tokens)
+        logging.info(
+            f"形態素解析: {len(texts)}文 (重複除去後 {len(unique_texts)}文, キャッシュヒット {len(unique_texts) - len(missing)}文), "
+            f"{len(missing)}文を{elapsed:.1f}秒で解析 ({len(missing) / max(elapsed, 1e-9):.0f}文/秒, ワーカー数: {self.tokenize_workers})"
+        )
+        return [tokenized[text] for text in texts]
+
+    @staticmethod
+    def get_feature_names(vectorizer):
+        try:
+            return vectorizer.get_feature_names_out()
+        except AttributeError:
+            return np.asarray(vectorizer.get_feature_names())
+
+    def load_law_texts(self, data):
+        """法令ごとの抽出テキスト（前後の空白を除き、空のものは除外）のリスト"""
+        records = load_law_texts(self.input_json_path, self.law_text_file, data=data)
+        return [[text.strip() for text in record['texts'] if text.strip()] for record in records]
+
+    def tag_corpus(self, data):
+        """全法令を1つのTF-IDFで学習し、法令ごとにスコア上位max_tags個の語をタグにする"""
+        law_texts = self.load_law_texts(data)
+        tokenized = iter(self.tokenize_texts([text for texts in law_texts for text in texts]))
+        documents = [" ".join(next(tokenized) for _ in texts) for texts in law_texts]
+
+        if not any(documents):
+            for law in data:
+                law["tags"] = []
+            return data
+
+        vectorizer = TfidfVectorizer()
+        tfidf_matrix = vectorizer.fit_transform(documents)
+        feature_names = self.get_feature_names(vectorizer)
+
+        # 除外語は語彙マスクとして列ごと0にする（上位を取った後で除外しない）
+        keep = np.array([name not in self.exclude_words for name in feature_names], dtype=tfidf_matrix.dtype)
+        tfidf_matrix = (tfidf_matrix @ sp.diags(keep)).tocsr()
+        tfidf_matrix.eliminate_zeros()
+
+        indptr, indices, scores = tfidf_matrix.indptr, tfidf_matrix.indices, tfidf_matrix.data
+        for row, law in enumerate(data):
+            row_indices = indices[indptr[row]:indptr[row + 1]]
+            row_scores = scores[indptr[row]:indptr[row + 1]]
+            if len(row_scores) > self.max_tags:
+                top = np.argpartition(-row_scores, self.max_tags - 1)[:self.max_tags]
+                row_indices, row_scores = row_indices[top], row_scores[top]
+            # スコアの降順（同点は語彙順）に並べる
+            order = np.lexsort((row_indices, -row_scores))
+            law["tags"] = [str(feature_names[i]) for i in row_indices[order]]
+        return data
+
+    def tag_per_law(self, data):
+        """法令ごとに文単位のTF-IDFを学習してタグを付ける（従来の方式）"""
+        law_texts = self.load_law_texts(data)
+        tokenized = iter(self.tokenize_texts([text for texts in law_texts for text in texts]))
+        for law, all_texts in zip(data, law_texts):
+            processed_texts = [next(tokenized) for _ in all_texts]
+
             if not processed_texts:
                 law["tags"] = []
                 continue
-            
+
             vectorizer = TfidfVectorizer()
             tfidf_matrix = vectorizer.fit_transform(processed_texts)
-            
-            try:
-                feature_names = vectorizer.get_feature_names_out()
-            except AttributeError:
-                feature_names = vectorizer.get_feature_names()
-            
+
+            feature_names = self.get_feature_names(vectorizer)
+
             word_scores = Counter()
             for doc in tfidf_matrix:
                 indices = doc.indices
                 scores = doc.data
                 for idx, score in zip(indices, scores):
                     word_scores[feature_names[idx]] += score
-            
+
             # 除外リストに含まれる単語をフィルタリング
             filtered_tags = [word for word, score in word_scores.most_common(10) if word not in self.exclude_words][:5]
-            
+
             law["tags"] = filtered_tags
-        
-        with open(self.output_json_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
-        
-        print(f"タグの抽出が完了しました: {self.output_json_path}")
+        return data
+
+    def execute(self):
+        """TF-IDFを使用してLawごとに特徴的なタグを抽出し、結果をJSONに保存"""
+        try:
+            with open(self.input_json_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+
+            if self.tfidf_mode == 'corpus':
+                self.tag_corpus(data)
+            else:
+                self.tag_per_law(data)
+            pipeline_metrics.add_items(len(data))
+
+            with open(self.output_json_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=4)
+
+            print(f"タグの抽出が完了しました: {self.output_json_path}")
+        finally:
+            # 失敗した場合も分かち書きキャッシュへの書き込みを確定し、接続を閉じる
+            # （ステップはスケジューラのスレッドで実行されるため、開いたままにしない）
+            if self.token_cache:
+                self.token_cache.close()
+
+
+def benchmark(input_json_path, worker_counts=(1, 2, 4, 8)):
+    """法令JSONの全文をワーカー数を変えて分かち書きし、処理速度を比較する（キャッシュは使わない）"""
+    step = TfidfTagStep({'input_json_file': input_json_path, 'output_json_file': ''})
+    texts = [text for law_texts in step.load_law_texts(None) for text in law_texts]
+    for workers in worker_counts:
+        step.tokenize_workers = workers
+        start = time.perf_counter()
+        step.tokenize_texts(texts)
+        elapsed = time.perf_counter() - start
+        print(f"workers={workers}: {elapsed:.2f}s ({len(set(texts)) / max(elapsed, 1e-9):.0f} sentences/s)")
+
 
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        benchmark(sys.argv[1])
@@ -1,4 +1,5 @@
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 from urllib.parse import urljoin, urlparse, unquote
 import os
@@ -7,36 +8,96 @@ import time
 import random
 import mimetypes
 import chardet
-import urllib.robotparser
 import json  # Ensure json is imported
+import tempfile
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import pipeline_metrics
+from lib.host_throttle import HostThrottle
+from lib.crawl_frontier import CrawlFrontier, RobotsCache, canonicalize_url
+from lib.crawl_state import CrawlState
+from lib.page_parser import decode_html, extract_hrefs, is_html, is_text
 
 class WebScraperStep:
     def __init__(self, step_config):
-        self.start_url = step_config['start_url']
+        self.start_url = canonicalize_url(step_config['start_url'])
         self.user_agent = step_config['user_agent']
         self.output_dir = step_config['output_dir']
-        self.progress_file = step_config['progress_file']
+        self.progress_file = step_config.get('progress_file', '')
         self.save_every = step_config['save_every']
-        self.visited = self.load_progress()
         self.counter = 0
-        progress_data = self.load_progress()
+        # 進行状況をSQLiteに保存する（指定時は progress_file は初回の取り込みにだけ使う）
+        self.crawl_state_db = step_config.get('crawl_state_db')
+        self.state = CrawlState(self.crawl_state_db) if self.crawl_state_db else None
+        # 再クロール: 訪問済みのページも条件付きリクエスト（If-None-Match / If-Modified-Since）で取得し直す
+        self.recrawl = bool(step_config.get('recrawl', False)) and self.state is not None
+        if step_config.get('recrawl') and self.state is None:
+            print("recrawl requires crawl_state_db; crawling only unvisited pages.")
+        # 新しく取得した・内容が変わったURLの一覧の出力先（後続ステップが変更分だけを処理するため）
+        # 後続ステップが処理して空にするまで、実行をまたいで追記していく
+        self.changed_urls_file = step_config.get('changed_urls_file', '')
+        self.changed_urls = []
+        self.changed_count = 0
+        if self.state:
+            if self.state.is_empty() and self.progress_file and os.path.exists(self.progress_file):
+                self.state.import_progress_file(self.progress_file)
+            progress_data = {'visited': self.state.visited(), 'to_visit': self.state.frontier() or [self.start_url]}
+        else:
+            progress_data = self.load_progress()
         self.visited = progress_data.get('visited', {})
-        self.to_visit = progress_data.get('to_visit', [self.start_url])
+        # 未訪問URLのキュー（投入済み・訪問済みのURLは再投入しない）
+        # 以前の進行状況ファイルのURLも正規化して照合する
+        to_visit = [canonicalize_url(url) for url in progress_data.get('to_visit', [self.start_url]) if url]
+        if self.recrawl:
+            # 開始URLから辿り直し、リンクが見つからなくなったページも含めて全ての訪問済みページを確認する
+            self.validators = self.state.validators()
+            self.frontier = CrawlFrontier([self.start_url] + to_visit + list(self.visited))
+        else:
+            self.validators = {}
+            self.frontier = CrawlFrontier(to_visit, set(self.visited) | {canonicalize_url(url) for url in self.visited})
+        if self.state:
+            for url in self.frontier.to_list():
+                self.state.push(url)
+            self.state.commit()
+        # sequential: 1ページずつ（従来通りリクエストごとにランダムに待つ）
+        # concurrent: スレッドプールで並列に取得し、ホストごとに同時接続数と間隔を制限する
+        self.crawl_mode = step_config.get('crawl_mode', 'sequential')
+        self.crawl_workers = int(step_config.get('crawl_workers', 8))
+        self.per_host_concurrency = int(step_config.get('per_host_concurrency', 2))
+        self.per_host_delay = float(step_config.get('per_host_delay', 1.0))
+        self.request_timeout = float(step_config.get('request_timeout', 30))
+        # 画像・PDFなどを書き出す単位（バイト）
+        self.download_chunk_size = int(step_config.get('download_chunk_size', 64 * 1024))
+        self.throttle = HostThrottle(self.per_host_concurrency, self.per_host_delay)
+        # 取得中のURL（中断しても次回取得し直せるよう、進行状況には未訪問として保存する）
+        self.in_flight = set()
+        # keep-aliveで接続を再利用するセッション（接続プールはワーカー数に合わせる）
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = self.user_agent
+        adapter = HTTPAdapter(pool_connections=self.crawl_workers, pool_maxsize=self.crawl_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # ホストごとのrobots.txt（robots_ttl秒ごとに取得し直す）
+        self.robots = RobotsCache(self.session, self.user_agent, float(step_config.get('robots_ttl', 3600)), self.request_timeout)
 
     def save_progress(self):
+        # 中断しても変更されたURLが失われないよう、進行状況と一緒に書き出す
+        self.save_changed_urls()
+        if self.state:
+            # 追加・削除済みの行を確定するだけ（全体の書き直しはしない）
+            self.state.commit()
+            return
         progress_data = {
             'visited': self.visited,
-            'to_visit': self.to_visit
+            'to_visit': list(self.in_flight) + self.frontier.to_list()
         }
         with open(self.progress_file, 'w') as file:
             json.dump(progress_data, file, indent=2)
 
     # 対象がスクレイピングOKか確認
     def is_allowed_url(self, url):
-        parser = urllib.robotparser.RobotFileParser()
-        parser.set_url(urllib.parse.urljoin(url, '/robots.txt'))
-        parser.read()
-        return parser.can_fetch(self.user_agent, url)
+        return self.robots.can_fetch(url)
    
     # 進行状況を取得
     def load_progress(self):
@@ -51,22 +112,61 @@ class WebScraperStep:
         _, ext = os.path.splitext(parsed_url.path)
         return ext if ext else '.html'  # デフォルトは .html
 
-    # 
-    def save_page_content(self, url, content, response):
+    # 保存先パスを作成
+    def page_file_path(self, url):
         # ファイル拡張子取得
-        content_type = response.headers.get('Content-Type', '')
         extension = self.get_extension_from_url(url)
-        # 保存先パスを作成
         url_hash = hashlib.md5(url.encode('utf-8')).hexdigest()
-        download_dir = os.getenv('OUTPUT_DIR', './output')
-        filename = f"{download_dir}/{url_hash}{extension}"
-        # 保存
-        mode = 'wb' if content_type.startswith('image/') else 'w'
-        with open(filename, mode, encoding='utf-8' if mode == 'w' else None) as file:
-            file.write(content if mode == 'w' else response.content)
-        # 完了履歴の追加
+        download_dir = os.getenv('OUTPUT_DIR', self.output_dir)
+        return f"{download_dir}/{url_hash}{extension}"
+
+    # ページ（テキスト）をUTF-8でファイルに書き出す（ワーカースレッドからも呼ばれる）
+    def write_page_file(self, url, content):
+        filename = self.page_file_path(url)
+        with open(filename, 'w', encoding='utf-8') as file:
+            file.write(content)
         print(f"Saved {url} as {filename}")
+        return filename
+
+    def download_file(self, url, response, previous_hash=None):
+        """
+        画像・PDFなどをメモリに溜めずにチャンクごとにファイルへ書き出す。
+        (保存先ファイル, 内容のハッシュ, 内容が変わったか) を返す。前回と同じ内容ならファイルは置き換えない。
+        """
+        filename = self.page_file_path(url)
+        tmp_filename = f"{filename}.{threading.get_ident()}.tmp"
+        sha256 = hashlib.sha256()
+        try:
+            with open(tmp_filename, 'wb') as file:
+                for chunk in response.iter_content(chunk_size=self.download_chunk_size):
+                    sha256.update(chunk)
+                    file.write(chunk)
+            content_hash = sha256.hexdigest()
+            if content_hash == previous_hash and os.path.exists(filename):
+                os.remove(tmp_filename)
+                return filename, content_hash, False
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+        print(f"Saved {url} as {filename}")
+        return filename, content_hash, True
+
+    # 
+    def save_page_content(self, url, content):
+        filename = self.write_page_file(url, content)
+        self.record_visit(url, filename)
+
+    # 完了履歴の追加（メインスレッドからのみ呼ぶ）
+    def record_visit(self, url, filename, page=None):
         self.visited[url] = filename
+        page = page or {}
+        if page.get('changed', True):
+            self.changed_urls.append(url)
+        if self.state:
+            self.state.record_visit(url, filename, page.get('etag'), page.get('last_modified'),
+                                    page.get('content_hash'), page.get('changed', True))
         
         # counterをインクリメントして、指定された数ごとに進行状況を保存
         self.counter += 1
@@ -79,43 +179,265 @@ class WebScraperStep:
             progress_percentage = (completed / total) * 100
             print(f"Progress: {completed}/{total} ({progress_percentage:.2f}%) completed.", end='\r')
  
+    def conditional_headers(self, url):
+        """前回の検証子から条件付きリクエストのヘッダーを作る"""
+        validator = self.validators.get(url) or {}
+        headers = {}
+        if validator.get('etag'):
+            headers['If-None-Match'] = validator['etag']
+        if validator.get('last_modified'):
+            headers['If-Modified-Since'] = validator['last_modified']
+        return headers
+
+    def extract_links(self, url, html):
+        """同じサイト内のリンクを正規化して返す。url は相対リンクの基準（リダイレクト後の実際のURL）"""
+        links = []
+        start_netloc = urlparse(self.start_url).netloc
+        for href in extract_hrefs(html):
+            absolute_link = urljoin(url, href.strip())
+            if urlparse(absolute_link).scheme in ('http', 'https') and urlparse(absolute_link).netloc == start_netloc:
+                links.append(canonicalize_url(absolute_link))
+        return links
+
+    def unchanged_page(self, url, filename, response):
+        """内容が前回と同じページ。保存済みのファイルからリンクを取り出して辿り続ける"""
+        links = []
+        if filename.endswith(('.html', '.htm')) and os.path.exists(filename):
+            with open(filename, 'r', encoding='utf-8', errors='replace') as file:
+                links = self.extract_links(response.url or url, file.read())
+        validator = self.validators.get(url) or {}
+        return {
+            'filename': filename,
+            'links': links,
+            'etag': response.headers.get('ETag') or validator.get('etag'),
+            'last_modified': response.headers.get('Last-Modified') or validator.get('last_modified'),
+            'content_hash': validator.get('content_hash'),
+            'changed': False,
+        }
+
+    def fetch_page(self, url):
+        """
+        ページを取得してファイルに保存し、保存先ファイル・同じサイト内のリンク・検証子・内容のハッシュ・
+        内容が変わったかどうかを返す。取得できなかった（200/304以外の）場合は None。
+        """
+        # 本文は必要になるまで読まない（画像・PDFはチャンクごとにファイルへ書き出す）
+        with self.session.get(url, headers=self.conditional_headers(url), timeout=self.request_timeout, stream=True) as response:
+            pipeline_metrics.incr('pages_fetched')
+            previous_file = self.visited.get(url)
+            previous_hash = (self.validators.get(url) or {}).get('content_hash')
+
+            if response.status_code == 304 and previous_file:
+                pipeline_metrics.incr('pages_not_modified')
+                return self.unchanged_page(url, previous_file, response)
+            if response.status_code != 200:
+                return None
+
+            page = {
+                'links': [],
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+            content_type = response.headers.get('Content-Type', '')
+            if not (is_text(content_type) or (not content_type and is_html(content_type, url))):
+                page['filename'], page['content_hash'], page['changed'] = self.download_file(url, response, previous_hash)
+                if not page['changed']:
+                    pipeline_metrics.incr('pages_unchanged')
+                return page
+
+            content = response.content
+        content_hash = hashlib.sha256(content).hexdigest()
+        if previous_file and content_hash == previous_hash and os.path.exists(previous_file):
+            # 304は返らなかったが内容は同じ：ファイルは書き直さない
+            pipeline_metrics.incr('pages_unchanged')
+            return self.unchanged_page(url, previous_file, response)
+
+        # 文字コードはヘッダー・<meta>を優先し、chardetは先頭の一部だけで判定する
+        text, _ = decode_html(content, content_type)
+        page['filename'] = self.write_page_file(url, text)
+        # 相対リンクはリダイレクト後の実際のURLを基準に解決する
+        page['links'] = self.extract_links(response.url or url, text) if is_html(content_type, url) else []
+        page['content_hash'] = content_hash
+        page['changed'] = True
+        return page
+
+    def fetch_allowed_page(self, url):
+        """robots.txtで許可されていれば、ホストごとの制限の範囲で取得する（ワーカースレッドで実行）"""
+        if not self.is_allowed_url(url):
+            return None
+        with self.throttle.slot(url):
+            return self.fetch_page(url)
+
+    def handle_page(self, url, page, progress):
+        """取得結果を履歴とキューに反映する（メインスレッドで実行）"""
+        if not page:
+            self.discard(url)
+            return
+        self.record_visit(url, page['filename'], page)
+        progress['completed'] += 1  # 完了カウントをインクリメント
+        pipeline_metrics.add_items()
+        self.print_progress(progress['completed'], progress['total'])  # 進捗表示の更新
+        for absolute_link in page['links']:
+            if self.frontier.push(absolute_link) and self.state:
+                self.state.push(absolute_link)
+
+    def discard(self, url):
+        """取得しなかったURLを保存済みのキューからも外す"""
+        if self.state:
+            self.state.discard(url)
+
     def scrape_site(self):
-        total_urls = len(self.to_visit) + len(self.visited)  # 最初の総URL数
-        completed_urls = len(self.visited)  # 最初の完了URL数
+        progress = {
+            'total': len(self.frontier) + len(self.visited),  # 最初の総URL数
+            'completed': len(self.visited),  # 最初の完了URL数
+        }
+        if self.recrawl:
+            # 再クロールでは訪問済みのページもキューに入っている
+            progress = {'total': len(self.frontier), 'completed': 0}
     
-        download_dir = os.getenv('OUTPUT_DIR', './output')
+        download_dir = os.getenv('OUTPUT_DIR', self.output_dir)
         # Ensure the download directory exists
         os.makedirs(download_dir, exist_ok=True)
 
-   
-        while self.to_visit:
-            current_url = self.to_visit.pop(0)
-            if not current_url or current_url in self.visited or not self.is_allowed_url(current_url):
+        if self.crawl_mode == 'concurrent':
+            self.scrape_site_concurrent(progress)
+        else:
+            self.scrape_site_sequential(progress)
+        self.save_progress()
+        if self.changed_urls_file:
+            print(f"\nChanged pages: {self.changed_count} (appended to {self.changed_urls_file})")
+
+        print("\nScraping completed.")  # 最後に改行を入れて終了メッセージを表示 
+
+    def save_changed_urls(self):
+        """新しく取得した・内容が変わったURLを、後続ステップがまだ処理していないURLの一覧に追記する"""
+        if not self.changed_urls_file or (not self.changed_urls and os.path.exists(self.changed_urls_file)):
+            return
+        pending = []
+        if os.path.exists(self.changed_urls_file):
+            with open(self.changed_urls_file, 'r', encoding='utf-8') as file:
+                pending = json.load(file)
+        changed_dir = os.path.dirname(self.changed_urls_file)
+        if changed_dir:
+            os.makedirs(changed_dir, exist_ok=True)
+        with open(self.changed_urls_file + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump(list(dict.fromkeys(pending + self.changed_urls)), file, ensure_ascii=False, indent=2)
+        os.replace(self.changed_urls_file + '.tmp', self.changed_urls_file)
+        self.changed_count += len(self.changed_urls)
+        self.changed_urls = []
+
+    def scrape_site_sequential(self, progress):
+        while self.frontier:
+            current_url = self.frontier.pop()
+            if (current_url in self.visited and not self.recrawl) or not self.is_allowed_url(current_url):
+                self.discard(current_url)
                 continue
     
             try:
                 time.sleep(random.uniform(0.5, 1.5))  # Random delay to reduce server load
-                response = requests.get(current_url, headers={'User-Agent': self.user_agent})
-                detected_encoding = chardet.detect(response.content)['encoding']
-                response.encoding = detected_encoding
-
-                if response.status_code == 200:
-                    soup = BeautifulSoup(response.text, 'html.parser')
-                    self.save_page_content(current_url, response.text, response)
-                    completed_urls += 1  # 完了カウントをインクリメント
-                    self.print_progress(completed_urls, total_urls)  # 進捗表示の更新
-    
-                    for link in soup.find_all('a', href=True):
-                        absolute_link = urljoin(current_url, link['href'])
-                        if absolute_link not in self.visited and urlparse(absolute_link).netloc == urlparse(self.start_url).netloc:
-                            self.to_visit.append(absolute_link)
+                self.handle_page(current_url, self.fetch_page(current_url), progress)
     
             except Exception as e:
                 print(f"Error scraping {current_url}: {e}")
+                self.discard(current_url)
                 continue
 
-        print("\nScraping completed.")  # 最後に改行を入れて終了メッセージを表示 
+    def scrape_site_concurrent(self, progress):
+        """
+        取得はワーカースレッド、履歴とキューの更新はこのスレッドで行う。
+        キューの先頭から、取得中のURLがcrawl_workersの2倍になるまで投入する。
+        """
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.crawl_workers) as executor:
+            while self.frontier or running:
+                while self.frontier and len(running) < self.crawl_workers * 2:
+                    current_url = self.frontier.pop()
+                    if current_url in self.visited and not self.recrawl:
+                        self.discard(current_url)
+                        continue
+                    self.in_flight.add(current_url)
+                    running[executor.submit(self.fetch_allowed_page, current_url)] = current_url
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    current_url = running.pop(future)
+                    self.in_flight.discard(current_url)
+                    try:
+                        self.handle_page(current_url, future.result(), progress)
+                    except Exception as e:
+                        print(f"Error scraping {current_url}: {e}")
+                        self.discard(current_url)
+
     def execute(self):
         self.scrape_site()
+        if self.state:
+            self.state.close()
+
+
+def benchmark(pages=100, latency=0.05, modes=('sequential', 'concurrent')):
+    """ローカルのフィクスチャサイトをクロールし、モードごとのページ/秒と接続数を比較する"""
+    from lib import fake_site_server
+
+    for mode in modes:
+        server, start_url = fake_site_server.start_server(pages=pages, latency=latency)
+        with tempfile.TemporaryDirectory() as work_dir:
+            step = WebScraperStep({
+                'start_url': start_url,
+                'user_agent': 'pipeline-benchmark',
+                'output_dir': os.path.join(work_dir, 'output'),
+                'progress_file': os.path.join(work_dir, 'progress.json'),
+                'save_every': 50,
+                'crawl_mode': mode,
+                'per_host_concurrency': 4,
+                'per_host_delay': 0,
+            })
+            start = time.perf_counter()
+            step.scrape_site()
+            elapsed = time.perf_counter() - start
+        server.shutdown()
+        handler = fake_site_server.FakeSiteHandler
+        print(f"{mode}: {len(step.visited)} pages in {elapsed:.1f}s ({len(step.visited) / elapsed:.1f} pages/s), "
+              f"{handler.request_count} requests over {handler.connection_count} connections")
+
+
+def benchmark_parsing(page_dir, repeat=3):
+    """
+    保存済みのページ（page_dir内の .html）で、1ページあたりのCPU時間を比較する。
+    old: 全文をchardet → html.parserのBeautifulSoupでリンク抽出 / new: ヘッダー・<meta>優先の判定 → lxmlでリンク抽出
+    """
+    pages = []
+    for filename in sorted(os.listdir(page_dir)):
+        if filename.endswith(('.html', '.htm')):
+            with open(os.path.join(page_dir, filename), 'rb') as file:
+                pages.append(file.read())
+    if not pages:
+        print(f"No .html files in {page_dir}")
+        return
+
+    def old_path(content):
+        text = content.decode(chardet.detect(content)['encoding'] or 'utf-8', errors='replace')
+        return [link['href'] for link in BeautifulSoup(text, 'html.parser').find_all('a', href=True)]
+
+    def new_path(content):
+        text, _ = decode_html(content, 'text/html')
+        return extract_hrefs(text)
+
+    total_bytes = sum(len(content) for content in pages)
+    print(f"{len(pages)} pages, {total_bytes / len(pages) / 1024:.0f} KB/page on average")
+    for name, parse in (('old', old_path), ('new', new_path)):
+        start = time.process_time()
+        for _ in range(repeat):
+            links = sum(len(parse(content)) for content in pages)
+        elapsed = (time.process_time() - start) / repeat
+        print(f"{name}: {elapsed / len(pages) * 1000:.2f} ms CPU/page ({links} links)")
 
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WebScraperStepのベンチマーク")
+    parser.add_argument('pages', nargs='?', type=int, default=100, help="クロール速度の比較に使うフィクスチャサイトのページ数")
+    parser.add_argument('--parse-benchmark', metavar='PAGE_DIR', help="保存済みページで1ページあたりの解析時間を比較する")
+    args = parser.parse_args()
+    if args.parse_benchmark:
+        benchmark_parsing(args.parse_benchmark)
+    else:
+        benchmark(args.pages)
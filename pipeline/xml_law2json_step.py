@@ -1,87 +1,281 @@
 import os
 import json
+import hashlib
+import textwrap
 import xmltodict
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import pipeline_metrics
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+
+def parse_key_list(value):
+    """"TOC, SupplProvision" のようなカンマ区切り文字列（またはリスト）をキーの集合にする"""
+    if not value:
+        return frozenset()
+    if isinstance(value, str):
+        value = value.split(',')
+    return frozenset(key.strip() for key in value if key.strip())
+
+
+def convert_law_xml(xml_path, keys_to_remove, array_items):
+    """
+    法令XMLを1ファイル変換する。
+    キーの削除とリスト化はxmltodictのパース中に行うので、変換後の辞書を作り直す必要がない。
+    """
+    def postprocessor(path, key, value):
+        if key in keys_to_remove:
+            return None
+        return key, value
+
+    with open(xml_path, 'rb') as f:
+        return xmltodict.parse(
+            f,
+            postprocessor=postprocessor if keys_to_remove else None,
+            force_list=array_items or None,
+        )
+
+
+def convert_law_file(task):
+    """
+    プロセスプールのワーカーで1ファイルを変換し、出力用の文字列まで作って返す。
+    戻り値: (ファイル名, 出力文字列 or None, エラーメッセージ or None)
+    """
+    xml_path, keys_to_remove, array_items, output_format = task
+    filename = os.path.basename(xml_path)
+    try:
+        record = convert_law_xml(xml_path, keys_to_remove, array_items)
+        return filename, LawJsonWriter.serialize(record, output_format), None
+    except Exception as e:
+        return filename, None, f"{type(e).__name__}: {e}"
+
+
+class LawJsonWriter:
+    """
+    変換した法令を1件ずつ出力ファイルへ書き出す。
+    json: 従来と同じ形式のJSON配列 / jsonl: 1行1法令
+    一時ファイルに書き、完了時に置き換える。
+    """
+
+    def __init__(self, output_file, output_format='json'):
+        self.output_file = output_file
+        self.output_format = output_format
+        self.tmp_file = f"{output_file}.tmp"
+        self.file = None
+        self.count = 0
+
+    def __enter__(self):
+        self.file = open(self.tmp_file, 'w', encoding='utf-8')
+        if self.output_format != 'jsonl':
+            self.file.write('[')
+        return self
+
+    @staticmethod
+    def serialize(record, output_format='json'):
+        """1法令分の出力文字列を作る（ワーカー側でも呼べるようにstaticmethodにしている）"""
+        if output_format == 'jsonl':
+            return json.dumps(record, ensure_ascii=False)
+        return textwrap.indent(json.dumps(record, ensure_ascii=False, indent=2), '  ')
+
+    def write(self, record):
+        self.write_serialized(self.serialize(record, self.output_format))
+
+    def write_serialized(self, text):
+        if self.output_format == 'jsonl':
+            self.file.write(text)
+            self.file.write('\n')
+        else:
+            self.file.write(',\n' if self.count else '\n')
+            self.file.write(text)
+        self.count += 1
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.output_format != 'jsonl':
+            self.file.write('\n]' if self.count else ']')
+        self.file.close()
+        if exc_type is None:
+            os.replace(self.tmp_file, self.output_file)
+        else:
+            os.remove(self.tmp_file)
+        return False
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ConversionManifest:
+    """
+    前回変換したXMLファイルの (サイズ, mtime, 内容ハッシュ) と、変換済みレコードの保存先を管理する。
+    変換済みレコード（出力用の文字列）は record_dir に内容ハッシュ＋変換設定ごとのファイルとして保存する。
+    """
+
+    def __init__(self, manifest_file, record_dir, settings):
+        self.manifest_file = manifest_file
+        self.record_dir = record_dir
+        # 変換設定が変わったら別のレコードとして扱う
+        self.settings_hash = hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        self.files = {}
+        self.new_files = {}
+        if os.path.exists(manifest_file):
+            with open(manifest_file, 'r', encoding='utf-8') as f:
+                self.files = json.load(f).get('files', {})
+        os.makedirs(record_dir, exist_ok=True)
+
+    def record_path(self, sha256):
+        return os.path.join(self.record_dir, f"{sha256}.{self.settings_hash}")
+
+    def lookup(self, xml_path):
+        """変換済みレコードが使えればそのパスを、変更されていれば None を返す"""
+        filename = os.path.basename(xml_path)
+        stat = os.stat(xml_path)
+        entry = self.files.get(filename)
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            sha256 = entry['sha256']
+        else:
+            # サイズかmtimeが変わっていれば内容のハッシュで判定する
+            sha256 = file_sha256(xml_path)
+        self.new_files[filename] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}
+        record_path = self.record_path(sha256)
+        return record_path if os.path.exists(record_path) else None
+
+    def store(self, xml_path, serialized):
+        entry = self.new_files[os.path.basename(xml_path)]
+        record_path = self.record_path(entry['sha256'])
+        with open(record_path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(serialized)
+        os.replace(record_path + '.tmp', record_path)
+
+    def save(self):
+        """今回のファイル一覧でマニフェストを書き直し、使われなくなったレコードを削除する"""
+        removed = set(self.files) - set(self.new_files)
+        live = {os.path.basename(self.record_path(entry['sha256'])) for entry in self.new_files.values()}
+        for name in os.listdir(self.record_dir):
+            if name not in live:
+                os.remove(os.path.join(self.record_dir, name))
+        with open(self.manifest_file + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'files': self.new_files}, f, ensure_ascii=False, indent=2)
+        os.replace(self.manifest_file + '.tmp', self.manifest_file)
+        return removed
+
+
 class XmlLawToJsonStep:
     def __init__(self, step_config):
         self.xml_input_dir = step_config.get('xml_input_dir', '')
         self.json_output_file = step_config.get('json_output_file', '')
-        self.keys_to_remove = step_config.get('keys_to_remove', '')
-        self.array_item = step_config.get('array_item', '')
-
-    def remove_keys(self, data, keys_to_remove):
-        """
-        指定されたキーを辞書から削除する。
-        ネストされた辞書にも対応。
-        """
-        if isinstance(data, dict):
-            return {
-                k: self.remove_keys(v, keys_to_remove)
-                for k, v in data.items() if k not in keys_to_remove
-            }
-        elif isinstance(data, list):
-            return [self.remove_keys(item, keys_to_remove) for item in data]
-        else:
-            return data
-    
-    def ensure_list_format(self, data, array_item):
-        """
-        指定されたキーについて、単一の要素であってもリストとして保持する。
-        """
-        if isinstance(data, dict):
-            return {
-                k: [v] if k in array_item and not isinstance(v, list) else self.ensure_list_format(v, array_item)
-                for k, v in data.items()
-            }
-        elif isinstance(data, list):
-            return [self.ensure_list_format(item, array_item) for item in data]
-        else:
-            return data
+        self.keys_to_remove = parse_key_list(step_config.get('keys_to_remove', ''))
+        self.array_item = parse_key_list(step_config.get('array_item', ''))
+        # json: 従来通りのJSON配列 / jsonl: 1行1法令
+        self.output_format = step_config.get('output_format', 'json')
+        # 変換に使うプロセス数（1ならこのプロセスで順に変換）
+        self.workers = int(step_config.get('workers', 1))
+        # ファイルごとのエラーの一覧を書き出すファイル（未指定ならログのみ）
+        self.error_summary_file = step_config.get('error_summary_file', '')
+        self.errors = []
+        # 差分変換用のマニフェスト（未指定なら毎回全ファイルを変換）
+        self.manifest_file = step_config.get('manifest_file', '')
+        self.record_cache_dir = step_config.get('record_cache_dir', '') or f"{os.path.splitext(self.manifest_file)[0]}_records"
+
+    def list_xml_files(self):
+        """入力ディレクトリのXMLファイルをファイル名順に返す（実行ごとに出力順が変わらないように）"""
+        return sorted(
+            os.path.join(self.xml_input_dir, filename)
+            for filename in os.listdir(self.xml_input_dir)
+            if filename.lower().endswith('.xml')
+        )
+
+    def convert_files(self, xml_paths):
+        """ファイルを変換し、入力順に (ファイル名, 出力文字列, エラー) を返すイテレータ"""
+        tasks = [(path, self.keys_to_remove, self.array_item, self.output_format) for path in xml_paths]
+        if self.workers <= 1:
+            yield from map(convert_law_file, tasks)
+            return
+        chunksize = max(1, min(64, len(tasks) // (self.workers * 4)))
+        # ステップはスケジューラのスレッドで実行されるため、forkではなくspawnでワーカーを起動する
+        # （他のスレッドが持っていたロックをコピーした子プロセスが止まることがある）
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            # executor.map は入力順に結果を返す
+            yield from executor.map(convert_law_file, tasks, chunksize=chunksize)
+
+    def report_errors(self):
+        if not self.errors:
+            return
+        logging.error(f"変換に失敗したXMLファイル: {len(self.errors)}件")
+        for error in self.errors:
+            logging.error(f"  {error['file']}: {error['error']}")
+        if self.error_summary_file:
+            with open(self.error_summary_file, 'w', encoding='utf-8') as f:
+                json.dump(self.errors, f, ensure_ascii=False, indent=2)
+            logging.info(f"エラー一覧を出力しました: {self.error_summary_file}")
 
     def execute(self):
         logging.info(f"XML入力ディレクトリ: {self.xml_input_dir}")
         logging.info(f"JSON出力ファイル: {self.json_output_file}")
-        
-        all_data = []
 
         if not os.path.isdir(self.xml_input_dir):
             logging.error(f"指定された入力ディレクトリが存在しません: {self.xml_input_dir}")
             return
 
-        for filename in os.listdir(self.xml_input_dir):
-            if filename.lower().endswith('.xml'):
-                xml_path = os.path.join(self.xml_input_dir, filename)
-                logging.info(f"処理対象XML: {xml_path}")
-
-                try:
-                    with open(xml_path, 'r', encoding='utf-8') as f:
-                        data_dict = xmltodict.parse(f.read())
-                    
-                    if self.keys_to_remove:
-                        data_dict = self.remove_keys(data_dict, self.keys_to_remove)
-                    
-                    if self.array_item:
-                        data_dict = self.ensure_list_format(data_dict, self.array_item)
-                    
-                    all_data.append(data_dict)
-                except Exception as e:
-                    logging.error(f"XMLファイルの読み込み・変換中にエラーが発生しました: {xml_path}")
-                    logging.error(e)
-
         output_dir = os.path.dirname(self.json_output_file)
         if output_dir and not os.path.exists(output_dir):
             os.makedirs(output_dir, exist_ok=True)
 
+        xml_paths = self.list_xml_files()
+        logging.info(f"処理対象XML: {len(xml_paths)}ファイル (プロセス数: {self.workers})")
+        self.errors = []
+
+        manifest = None
+        cached_records = {}
+        changed_paths = xml_paths
+        if self.manifest_file:
+            manifest = ConversionManifest(self.manifest_file, self.record_cache_dir, {
+                'keys_to_remove': sorted(self.keys_to_remove),
+                'array_item': sorted(self.array_item),
+                'output_format': self.output_format,
+            })
+            for xml_path in xml_paths:
+                record_path = manifest.lookup(xml_path)
+                if record_path:
+                    cached_records[xml_path] = record_path
+            changed_paths = [path for path in xml_paths if path not in cached_records]
+            logging.info(f"差分変換: 変更なし {len(cached_records)}ファイル, 追加・変更 {len(changed_paths)}ファイル")
+
         try:
-            with open(self.json_output_file, 'w', encoding='utf-8') as f:
-                json.dump(all_data, f, ensure_ascii=False, indent=2)
-            logging.info(f"JSON出力完了: {self.json_output_file}")
+            # 1ファイル変換するごとに書き出すので、メモリ使用量はファイル数によらない
+            converted = self.convert_files(changed_paths)
+            with LawJsonWriter(self.json_output_file, self.output_format) as writer:
+                for xml_path in xml_paths:
+                    if xml_path in cached_records:
+                        with open(cached_records[xml_path], 'r', encoding='utf-8') as f:
+                            writer.write_serialized(f.read())
+                        continue
+                    filename, serialized, error = next(converted)
+                    if error:
+                        logging.error(f"XMLファイルの読み込み・変換中にエラーが発生しました: {filename}")
+                        self.errors.append({'file': filename, 'error': error})
+                        continue
+                    if manifest:
+                        manifest.store(xml_path, serialized)
+                    writer.write_serialized(serialized)
+            logging.info(f"JSON出力完了: {self.json_output_file} ({writer.count}件)")
+            pipeline_metrics.add_items(writer.count)
+            pipeline_metrics.incr('xml_converted', len(changed_paths) - len(self.errors))
+            pipeline_metrics.incr('xml_reused', len(cached_records))
+            pipeline_metrics.incr('xml_errors', len(self.errors))
+            if manifest:
+                removed = manifest.save()
+                if removed:
+                    logging.info(f"削除されたXMLファイル: {len(removed)}件")
         except Exception as e:
             logging.error(f"JSONファイルの書き込み中にエラーが発生しました: {self.json_output_file}")
             logging.error(e)
 
-        logging.info("XML→JSON変換（全ファイルまとめて）が完了しました。")
+        self.report_errors()
 
+        logging.info("XML→JSON変換（全ファイルまとめて）が完了しました。")